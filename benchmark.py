@@ -0,0 +1,497 @@
+import argparse
+import configparser
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import process_data
+import psycopg2
+from botocore.exceptions import ClientError
+from pathlib import Path
+from config.definitions import ROOT_DIR
+from sql_queries import validation_suite, enriched_validation_suite, dashboard_queries, table_layouts, table_layout_clause, layout_copy_create, staged_columns
+
+# Plan steps where Redshift moves rows between nodes to run a join
+REDISTRIBUTION_STEPS = ['DS_DIST_INNER', 'DS_DIST_OUTER', 'DS_DIST_ALL_INNER',
+                        'DS_DIST_BOTH', 'DS_BCAST_INNER']
+
+# Synthetic counters are split between the two real source layouts
+SEATTLE_FOLDER = os.path.join('united_states', 'washington', 'seattle')
+MADISON_FOLDER = os.path.join('united_states', 'wisconsin', 'madison')
+SEATTLE_STATION = '72793'
+MADISON_STATION = '72641'
+
+def hourly_counts(timestamps, rng, scale=40):
+    '''
+    Produces plausible hourly bicycle counts: busy at commute times, quiet
+        overnight, with Poisson noise
+    Parameters:
+        timestamps (DatetimeIndex)
+        rng (numpy Generator)
+        scale (int): rough peak hourly count
+    Returns:
+        counts (numpy array)
+    '''
+    hour = timestamps.hour.values
+    shape = np.exp(-((hour - 8) ** 2) / 6) + np.exp(-((hour - 17) ** 2) / 6)
+    return rng.poisson(scale * shape + 1)
+
+def generate_seattle_counter(file_path, counter_name, timestamps, rng):
+    '''
+    Writes a counter file in Seattle's layout, e.g.
+        Date,Fremont Bridge Total,East,West
+        10/03/2012 12:00:00 AM,13,4,9
+    Parameters:
+        file_path (str)
+        counter_name (str)
+        timestamps (DatetimeIndex): local, hourly
+        rng (numpy Generator)
+    '''
+    north = hourly_counts(timestamps, rng)
+    south = hourly_counts(timestamps, rng)
+    df = pd.DataFrame({'Date': timestamps.strftime('%m/%d/%Y %I:%M:%S %p'),
+                       f'{counter_name} Total': north + south,
+                       'North': north,
+                       'South': south})
+    df.to_csv(file_path, index=False)
+
+def generate_madison_counter(file_path, timestamps, rng):
+    '''
+    Writes a counter file in Madison's layout, a UTF-8 BOM followed by e.g.
+        Count_Date,Count,OBJECTID
+        1/1/2015 0:00,2,0
+    Parameters:
+        file_path (str)
+        timestamps (DatetimeIndex): local, hourly
+        rng (numpy Generator)
+    '''
+    # no zero padding on month, day, or hour
+    count_date = (timestamps.month.astype(str) + '/'
+                  + timestamps.day.astype(str) + '/'
+                  + timestamps.year.astype(str) + ' '
+                  + timestamps.hour.astype(str) + ':00')
+    df = pd.DataFrame({'Count_Date': count_date,
+                       'Count': hourly_counts(timestamps, rng),
+                       'OBJECTID': np.arange(len(timestamps))})
+    df.to_csv(file_path, index=False, encoding='utf-8-sig')
+
+def generate_weather_file(file_path, timestamps, rng):
+    '''
+    Writes a meteostat-shaped hourly .csv.gz: no header, date, hour, then
+        the eleven measurements, with the gaps real stations have
+    Parameters:
+        file_path (str)
+        timestamps (DatetimeIndex): UTC, hourly
+        rng (numpy Generator)
+    '''
+    rows = len(timestamps)
+    seasonal = 10 - 12 * np.cos(2 * np.pi * timestamps.dayofyear.values / 365)
+    temperature = np.round(seasonal + rng.normal(0, 3, rows), 1)
+    precipitation = np.where(rng.random(rows) < 0.15,
+                             np.round(rng.exponential(1.5, rows), 1), 0.0)
+    missing = np.full(rows, np.nan)
+    df = pd.DataFrame({
+        'date': timestamps.strftime('%Y-%m-%d'),
+        'hour': timestamps.hour,
+        'temp': temperature,
+        'dwpt': np.round(temperature - rng.uniform(0, 8, rows), 1),
+        'rhum': rng.integers(30, 100, rows),
+        'prcp': precipitation,
+        'snow': missing,
+        'wdir': rng.integers(0, 360, rows),
+        'wspd': np.round(rng.gamma(2, 5, rows), 1),
+        'wpgt': missing,
+        'pres': np.round(rng.normal(1015, 8, rows), 1),
+        'tsun': missing,
+        'coco': np.where(precipitation > 0, 8, 1)})
+    df.to_csv(file_path, index=False, header=False, compression='gzip')
+
+def generate_dataset(root, counters, years, weather_years=None, seed=0):
+    '''
+    Builds a synthetic copy of the pipeline's input folders under root:
+        counter .csv's in data/bicycle_counters and meteostat files in
+        data/download
+    Parameters:
+        root (str): the stand-in project root
+        counters (int): number of counter files, alternating between the
+            Seattle and Madison layouts
+        years (int): years of hourly counts per counter
+        weather_years (int): years of weather history per station, defaults
+            to years. Longer histories exercise the date pushdown
+        seed (int): random seed, so runs are comparable
+    Returns:
+        bicycle_metadata (list): what prepare_bicycle_metadata would return
+            for these files, without any lookups
+    '''
+    rng = np.random.default_rng(seed)
+    weather_years = weather_years or years
+    start = pd.Timestamp('2015-01-01')
+    timestamps = pd.date_range(start, periods=years * 8760, freq='H')
+    weather_timestamps = pd.date_range(
+        start - pd.DateOffset(years=weather_years - years),
+        periods=weather_years * 8760 + 24, freq='H')
+
+    bicycle_folder = os.path.join(root, 'data', 'bicycle_counters')
+    download_folder = os.path.join(root, 'data', 'download')
+    for folder in [SEATTLE_FOLDER, MADISON_FOLDER]:
+        os.makedirs(os.path.join(bicycle_folder, folder), exist_ok=True)
+    os.makedirs(download_folder, exist_ok=True)
+
+    bicycle_metadata = []
+    for k in range(counters):
+        if k % 2 == 0:
+            file_path = Path(bicycle_folder, SEATTLE_FOLDER,
+                             f'Synthetic_{k}_Bicycle_Counter.csv')
+            generate_seattle_counter(file_path, f'Synthetic {k}',
+                                     timestamps, rng)
+            station, time_zone = SEATTLE_STATION, 'America/Los_Angeles'
+        else:
+            file_path = Path(bicycle_folder, MADISON_FOLDER,
+                             f'Eco-Totem_Synthetic_{k}_Bike_Counts.csv')
+            generate_madison_counter(file_path, timestamps, rng)
+            station, time_zone = MADISON_STATION, 'America/Chicago'
+        bicycle_metadata.append({'file_path': file_path,
+                                 'weather_station_code': station,
+                                 'time_zone': time_zone,
+                                 'city': file_path.parent.name,
+                                 'state': file_path.parent.parent.name,
+                                 'country': file_path.parent.parent.parent.name})
+
+    for station in sorted({item['weather_station_code']
+                           for item in bicycle_metadata}):
+        generate_weather_file(os.path.join(download_folder,
+                                           f'{station}.csv.gz'),
+                              weather_timestamps, rng)
+    return bicycle_metadata
+
+class LocalS3Client:
+    '''
+    Stands in for a boto3 S3 client by keeping objects in a local folder,
+        with just the calls copy_to_s3 makes
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _paths(self, bucket, key):
+        object_path = os.path.join(self.folder, bucket, key)
+        return object_path, object_path + '.metadata.json'
+
+    def head_object(self, Bucket, Key):
+        object_path, metadata_path = self._paths(Bucket, Key)
+        if not os.path.exists(object_path):
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        with open(metadata_path) as f:
+            return {'Metadata': json.load(f)}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        object_path, metadata_path = self._paths(Bucket, Key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        shutil.copyfile(Filename, object_path)
+        with open(metadata_path, 'w') as f:
+            json.dump((ExtraArgs or {}).get('Metadata', {}), f)
+
+def load_local_warehouse(source_path, con, chunk_size=100000):
+    '''
+    Stands in for the Redshift COPY by loading the staged .csv's into
+        SQLite tables named after their file prefix
+    Parameters:
+        source_path (str): the staging folder
+        con (sqlite3 connection)
+        chunk_size (int): rows inserted at a time
+    Returns:
+        rows (int): rows loaded
+    '''
+    rows = 0
+    for file in sorted(os.listdir(source_path)):
+        if not file.endswith('.csv'):
+            continue
+        table_name = file.split('-')[0].split('.')[0]
+        for chunk in pd.read_csv(os.path.join(source_path, file),
+                                 chunksize=chunk_size, dtype=str):
+            chunk.to_sql(table_name, con, if_exists='append', index=False)
+            rows += len(chunk)
+    con.commit()
+    return rows
+
+def measure(stage, results, func, *args, trace_memory=True, **kwargs):
+    '''
+    Runs one stage, recording its wall time and peak traced memory
+    Parameters:
+        stage (str): name used in the results
+        results (list): the measurement is appended here
+        func (callable): the stage
+        trace_memory (bool): track peak memory with tracemalloc, which
+            slows allocation-heavy code down
+    Returns:
+        the stage's return value
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - started
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    results.append({'stage': stage,
+                    'seconds': round(seconds, 4),
+                    'peak_mb': round(peak / 1024 ** 2, 1)
+                    if peak is not None else None})
+    return result
+
+def run_benchmarks(counters=4, years=2, weather_years=None, seed=0,
+                   trace_memory=True, workdir=None):
+    '''
+    Generates a synthetic dataset and times each local stage of the
+        pipeline against it. S3 and Redshift are replaced by a local folder
+        and SQLite, so no network or credentials are needed
+    Parameters:
+        counters (int): number of synthetic counter files
+        years (int): years of hourly counts per counter
+        weather_years (int): years of weather history per station
+        seed (int): random seed
+        trace_memory (bool): track peak memory per stage
+        workdir (str): where to build the stand-in project, a temporary
+            folder (removed afterwards) if not given
+    Returns:
+        results (list): one {'stage', 'seconds', 'peak_mb', 'rows'} per stage
+    '''
+    root = workdir or tempfile.mkdtemp(prefix='bicycle_benchmark_')
+    # every stage reads its folders relative to ROOT_DIR
+    process_data.ROOT_DIR = root
+    try:
+        bicycle_metadata = generate_dataset(root, counters, years,
+                                            weather_years, seed)
+        source_path = os.path.join(root, 'data', 'output')
+        os.makedirs(source_path, exist_ok=True)
+
+        results = []
+        # keys are only kept in memory, the real registry isn't touched
+        key_registry = process_data.assign_surrogate_keys(
+            bicycle_metadata, {'counters': {}, 'weather_stations': {}})
+        fact_dataframes = []
+        def build_dataframes():
+            for item in bicycle_metadata:
+                fact_dataframes.append(
+                    process_data.create_fact_dataframe(item))
+        measure('create_fact_dataframe', results, build_dataframes,
+                trace_memory=trace_memory)
+        results[-1]['rows'] = sum(len(df) for df in fact_dataframes)
+
+        # report only, so every row is still staged and validated
+        def check_fact_dataframes():
+            for i, df in enumerate(fact_dataframes):
+                process_data.apply_quality_gate(df, f'bicycle_fact-{i}',
+                                                'report')
+        measure('apply_quality_gate', results, check_fact_dataframes,
+                trace_memory=trace_memory)
+        results[-1]['rows'] = results[-2]['rows']
+
+        output_manifest = {}
+        def write_fact_csvs():
+            for i, df in enumerate(fact_dataframes):
+                process_data.create_output_csv(df, f'bicycle_fact-{i}.csv',
+                                               output_manifest)
+        measure('create_output_csv', results, write_fact_csvs,
+                trace_memory=trace_memory)
+        results[-1]['rows'] = results[-2]['rows']
+        fact_dataframes.clear()
+
+        weather_date_ranges = measure('transform_weather_data', results,
+                                      process_data.transform_weather_data,
+                                      100000, None, 'csv', output_manifest,
+                                      key_registry['weather_stations'],
+                                      trace_memory=trace_memory)
+        results[-1]['rows'] = process_data.manifest_control_totals(
+            output_manifest).get('weather_d', 0)
+
+        # the synthetic weather covers every counter's dates
+        measure('stage_dimensions', results, process_data.stage_dimensions,
+                source_path,
+                process_data.dimension_date_range({}, weather_date_ranges),
+                None, 'csv', output_manifest, trace_memory=trace_memory)
+        results[-1]['rows'] = process_data.manifest_control_totals(
+            output_manifest).get('date_d', 0)
+        process_data.stage_counter_dimension(source_path, key_registry, 'csv',
+                                             output_manifest)
+        measure('stage_enriched_tables', results,
+                process_data.stage_enriched_tables, source_path, 1, 'csv',
+                output_manifest, trace_memory=trace_memory)
+        results[-1]['rows'] = process_data.manifest_control_totals(
+            output_manifest).get('bicycle_weather_fact', 0)
+
+        source_counts = measure('source_control_totals', results,
+                                process_data.source_control_totals,
+                                source_path, trace_memory=trace_memory)
+        results[-1]['rows'] = sum(source_counts.values())
+        manifest_counts = measure('manifest_control_totals', results,
+                                  process_data.manifest_control_totals,
+                                  output_manifest, trace_memory=trace_memory)
+
+        s3_client = LocalS3Client(os.path.join(root, 's3'))
+        measure('copy_to_s3 (local stand-in)', results,
+                process_data.copy_to_s3, source_path, 'benchmark-bucket',
+                'gzip/', None, True, s3_client=s3_client,
+                trace_memory=trace_memory)
+
+        con = sqlite3.connect(os.path.join(root, 'warehouse.db'))
+        rows = measure('load (sqlite stand-in)', results,
+                       load_local_warehouse, source_path, con,
+                       trace_memory=trace_memory)
+        results[-1]['rows'] = rows
+        report = measure('run_validation_suite (sqlite stand-in)', results,
+                         process_data.run_validation_suite, con.cursor(),
+                         validation_suite + enriched_validation_suite,
+                         manifest_counts,
+                         trace_memory=trace_memory)
+        con.close()
+        if not report['passed'] or source_counts != manifest_counts:
+            logging.warning("Benchmark run didn't validate, see the logs")
+        return results
+    finally:
+        process_data.ROOT_DIR = ROOT_DIR
+        if workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+def time_queries(cur, queries, repeats=3):
+    '''
+    Times each query against the warehouse and notes the steps in its plan
+        that redistribute rows
+    Parameters:
+        cur (psycopg2 cursor)
+        queries (dict): {'query_name':query,...}
+        repeats (int): runs per query, the fastest is kept
+    Returns:
+        results (list): one {'query', 'seconds', 'rows', 'redistribution'}
+            per query
+    '''
+    results = []
+    for query_name, query in queries.items():
+        cur.execute('EXPLAIN ' + query)
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            cur.execute(query)
+            rows = len(cur.fetchall())
+            timings.append(time.perf_counter() - started)
+        results.append({'query': query_name,
+                        'seconds': round(min(timings), 4),
+                        'rows': rows,
+                        'redistribution': [step for step
+                                           in REDISTRIBUTION_STEPS
+                                           if step in plan]})
+    return results
+
+def run_query_benchmarks(con, repeats=3):
+    '''
+    Copies the loaded tables into two scratch schemas, one with
+        sql_queries.table_layouts and one distributed evenly without sort
+        keys, and times the dashboard queries against each. The result
+        cache is turned off so every run is executed
+    Parameters:
+        con (psycopg2 connection): to the loaded warehouse
+        repeats (int): runs per query
+    Returns:
+        results (list): one {'layout', 'query', 'seconds', 'rows',
+            'redistribution'} per query and layout
+    '''
+    layouts = {'layout_tuned': table_layouts,
+               'layout_even': {table_name: {'diststyle': 'EVEN'}
+                               for table_name in table_layouts}}
+    cur = con.cursor()
+    cur.execute('SET enable_result_cache_for_session TO off;')
+    results = []
+    try:
+        for schema, schema_layouts in layouts.items():
+            cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE;')
+            cur.execute(f'CREATE SCHEMA {schema};')
+            for table_name in staged_columns:
+                cur.execute(layout_copy_create.format(
+                    schema=schema, table_name=table_name,
+                    layout=table_layout_clause(schema_layouts[table_name])))
+            con.commit()
+            for table_name in staged_columns:
+                cur.execute(f'ANALYZE {schema}.{table_name};')
+            con.commit()
+            # the dashboard queries name their tables without a schema
+            cur.execute(f'SET search_path TO {schema};')
+            results += [dict(layout=schema, **result) for result
+                        in time_queries(cur, dashboard_queries, repeats)]
+            cur.execute('SET search_path TO public;')
+    finally:
+        con.rollback()
+        for schema in layouts:
+            cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE;')
+        con.commit()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times the local pipeline stages on synthetic data')
+    parser.add_argument('--counters', type=int, default=4,
+                        help='synthetic counter files to generate')
+    parser.add_argument('--years', type=int, default=2,
+                        help='years of hourly counts per counter')
+    parser.add_argument('--weather-years', type=int, default=None,
+                        help='years of weather history per station')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip tracemalloc for cleaner timings')
+    parser.add_argument('--workdir', default=None,
+                        help='keep the generated data in this folder')
+    parser.add_argument('--report', default=None,
+                        help='also write the results to this .json file')
+    parser.add_argument('--warehouse', action='store_true',
+                        help='instead time the dashboard queries against '
+                             'the loaded Redshift cluster, with and without '
+                             'the table layouts')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='runs per dashboard query')
+    args = parser.parse_args()
+
+    # keep the pipeline's per-file logging out of the results
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.warehouse:
+        config = configparser.ConfigParser()
+        config.read(os.path.join(ROOT_DIR, 'config', 'config.cfg'))
+        con = psycopg2.connect("host={} dbname={} user={} password={} port={}"\
+            .format(*config['CLUSTER'].values()))
+        try:
+            results = run_query_benchmarks(con, args.repeats)
+        finally:
+            con.close()
+        print(f"{'query':<28}{'layout':<15}{'seconds':>10}{'rows':>8}  "
+              f"redistribution")
+        for result in results:
+            print(f"{result['query']:<28}{result['layout']:<15}"
+                  f"{result['seconds']:>10}{result['rows']:>8}  "
+                  f"{', '.join(result['redistribution']) or '-'}")
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump({'parameters': vars(args), 'results': results}, f,
+                          indent=2)
+        return
+    results = run_benchmarks(args.counters, args.years, args.weather_years,
+                             args.seed, not args.no_memory, args.workdir)
+    print(f"{'stage':<42}{'seconds':>10}{'peak MB':>10}{'rows':>12}")
+    for result in results:
+        peak = result['peak_mb'] if result['peak_mb'] is not None else '-'
+        print(f"{result['stage']:<42}{result['seconds']:>10}{peak:>10}"
+              f"{result.get('rows', ''):>12}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f,
+                      indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,35 @@
 import os
 
 # define the root directory for this project
-ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
\ No newline at end of file
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+# on-disk cache of geocoding and weather station lookups
+LOCATION_CACHE_PATH = os.path.join(ROOT_DIR, 'data', 'cache',
+                                   'location_cache.json')
+
+# manifest of ingested counter files used by incremental runs
+INGEST_MANIFEST_PATH = os.path.join(ROOT_DIR, 'data', 'cache',
+                                    'ingest_manifest.json')
+
+# rows, bytes, and checksums of the files staged by the last run
+OUTPUT_MANIFEST_PATH = os.path.join(ROOT_DIR, 'data', 'cache',
+                                    'output_manifest.json')
+
+# structured results of the last run's warehouse validation
+VALIDATION_REPORT_PATH = os.path.join(ROOT_DIR, 'data', 'cache',
+                                      'validation_report.json')
+
+# per-stage timings, volumes, and memory of the last run
+RUN_REPORT_PATH = os.path.join(ROOT_DIR, 'data', 'cache', 'run_report.json')
+
+# date range already loaded into date_d, extended by incremental runs
+DIMENSION_STATE_PATH = os.path.join(ROOT_DIR, 'data', 'cache',
+                                    'dimension_state.json')
+
+# stable surrogate keys assigned to counters and weather stations
+KEY_REGISTRY_PATH = os.path.join(ROOT_DIR, 'data', 'cache',
+                                 'key_registry.json')
+
+# per-check results of the last run's pre-staging quality gate
+QUALITY_REPORT_PATH = os.path.join(ROOT_DIR, 'data', 'cache',
+                                   'quality_report.json')
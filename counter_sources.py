@@ -0,0 +1,46 @@
+# How each city's counter files are read, keyed by the country, state, and
+# city folders they're stored in under data/bicycle_counters. Every reader
+# names its date format, so dates are parsed with it instead of being
+# inferred row by row. Adding a city means adding a reader here
+#   encoding: the files' text encoding
+#   usecols: positions of the date and the count columns, in that order.
+#     The count may come first in the file
+#   dtype: read as, by column name ('date', 'bicycle_count'). Counts are
+#     whole numbers with the odd blank hour, so they're nullable integers
+#   date_format: strptime format of the local date/time column
+counter_sources = {
+    # Date,Fremont Bridge Total,Fremont Bridge East Sidewalk,...
+    # 10/03/2012 12:00:00 AM,13,4,9
+    ('united_states', 'washington', 'seattle'): {
+        'encoding': 'utf-8',
+        'usecols': [0, 1],
+        'dtype': {'date': str, 'bicycle_count': 'Int32'},
+        'date_format': '%m/%d/%Y %I:%M:%S %p'
+    },
+    # a UTF-8 BOM, then
+    # Count_Date,Count,OBJECTID
+    # 1/1/2015 0:00,2,0
+    # strptime doesn't need the zero padding the month, day, and hour lack
+    ('united_states', 'wisconsin', 'madison'): {
+        'encoding': 'utf-8-sig',
+        'usecols': [0, 1],
+        'dtype': {'date': str, 'bicycle_count': 'Int32'},
+        'date_format': '%m/%d/%Y %H:%M'
+    }
+}
+
+def counter_source(country, state, city):
+    '''
+    Looks up the reader for a city's counter files
+    Parameters:
+        country (str)
+        state (str)
+        city (str)
+    Returns:
+        source (dict): see counter_sources
+    '''
+    try:
+        return counter_sources[(country, state, city)]
+    except KeyError:
+        raise ValueError(f"No counter reader for {country}/{state}/{city}, "
+                         f"add one to counter_sources.py") from None
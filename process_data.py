@@ -1,23 +1,79 @@
 import boto3
+import concurrent.futures
 import configparser
+import contextlib
+import datetime
+import functools
+import gzip
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
+import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import psycopg2
 import re
 import requests
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 from meteostat import Stations
 from pathlib import Path
-from config.definitions import ROOT_DIR
-from sql_queries import create_table_queries, copy_table_queries, target_control_queries, dim_uniqueness_queries, bicycle_no_blanks
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+from counter_sources import counter_source
+from quality_checks import run_quality_checks
+from config.definitions import ROOT_DIR, LOCATION_CACHE_PATH, INGEST_MANIFEST_PATH, OUTPUT_MANIFEST_PATH, VALIDATION_REPORT_PATH, RUN_REPORT_PATH, DIMENSION_STATE_PATH, KEY_REGISTRY_PATH, QUALITY_REPORT_PATH
+from sql_queries import (
+    create_table_queries, incremental_create_table_queries,
+    staged_copy_queries, create_if_not_exists_queries, merge_load_queries,
+    date_dimension_create, validation_suite, compile_validation_suite,
+    distinct_key_alias, staged_columns, apply_table_layouts, vacuum_table,
+    analyze_table, stdin_copy, merge_stage_queries, enriched_columns,
+    weather_measures, enriched_create_table_queries, enriched_validation_suite,
+    create_if_not_exists, bicycle_fact_create, bigint_columns,
+    live_table_columns, kept_tables, outdated_live_tables)
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)-4s %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
-def prepare_bicycle_metadata():
+# Hours between consecutive weather stations' weather_d keys
+WEATHER_KEY_STRIDE = 10 ** 7
+
+# Precipitation above which an hour counts as rainy, as in the dashboards
+RAINY_HOUR_MM = 0.1
+
+# Offending rows kept per check in the quality report
+QUALITY_SAMPLE_ROWS = 5
+
+# Local hour -> UTC hour lookups by time zone, see utc_hour_lookup
+_utc_lookups = {}
+
+# Running checksums of the staged files this process is writing, keyed by
+# path, so appends keep extending the same hash
+_output_hashers = {}
+
+def prepare_bicycle_metadata(cache_ttl_days=30, refresh_cache=False):
     '''
     Walks through the data folder and parses information from its contents
+    Parameters:
+        cache_ttl_days (float): how long a cached location lookup is
+            trusted before it's fetched again
+        refresh_cache (bool): ignore any cached lookups and fetch them all
+            again
     Returns:
         bicycle_metadata (list): a collection of metadata dictionaries
     '''
@@ -25,31 +81,48 @@ def prepare_bicycle_metadata():
     data_folder = os.path.join(ROOT_DIR, 'data/bicycle_counters')
     bicycle_metadata = []
     # Reduces number of API calls needed
-    last_city = ''
-    last_state = ''
+    location_cache = load_location_cache()
+    cache_changed = False
+    # Keys fetched this run, so a refresh still looks each city up once
+    refreshed_keys = set()
     for root, dir, files in os.walk(data_folder):
-        for file in files:
+        # Sorted so bicycle_fact-{i}.csv numbering is stable between runs
+        dir.sort()
+        for file in sorted(files):
             file_path = Path(os.path.join(root, file))
             city = file_path.parent.name
             state = file_path.parent.parent.name
             country = file_path.parent.parent.parent.name
-            # Reduces number of API calls needed
-            if city != last_city and state != last_state:
+            cache_key = location_cache_key(country, state, city)
+            location = get_cached_location(location_cache, country, state,
+                                           city, cache_ttl_days,
+                                           refresh_cache and
+                                           cache_key not in refreshed_keys)
+            if location is None:
                 latitude, longitude = get_lat_long(city, state)
                 weather_station_code, time_zone = get_nearby_weather_station(
                     latitude,
                     longitude)
-
-            bicycle_dict = {"file_path": file_path,
+                location = {"latitude": latitude,
+                            "longitude": longitude,
                             "weather_station_code": weather_station_code,
                             "time_zone": time_zone,
+                            "cached_at": time.time()}
+                location_cache[cache_key] = location
+                refreshed_keys.add(cache_key)
+                cache_changed = True
+
+            bicycle_dict = {"file_path": file_path,
+                            "weather_station_code":
+                                location['weather_station_code'],
+                            "time_zone": location['time_zone'],
                             "city": city,
                             "state": state,
                             "country": country}
             bicycle_metadata.append(bicycle_dict)
-            last_city = city
-            last_state = state
-            
+
+    if cache_changed:
+        save_location_cache(location_cache)
     return bicycle_metadata
 
 def get_lat_long(city, state):
@@ -90,6 +163,100 @@ def get_nearby_weather_station(latitude, longitude):
     time_zone = station_data['timezone']
     return nearby_station, time_zone
     
+def location_cache_key(country, state, city):
+    '''
+    Builds the key a location is stored under in the location cache
+    Parameters:
+        country (str)
+        state (str)
+        city (str)
+    Returns:
+        key (str): 'country/state/city'
+    '''
+    return f'{country}/{state}/{city}'
+
+def load_location_cache(cache_path=LOCATION_CACHE_PATH):
+    '''
+    Reads the on-disk cache of geocoding and weather station lookups
+    Parameters:
+        cache_path (str): path to the cache .json
+    Returns:
+        location_cache (dict): {'country/state/city':location_dict,...}
+    '''
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.info(f"Ignoring unreadable location cache {cache_path}: {e}")
+        return {}
+
+def save_location_cache(location_cache, cache_path=LOCATION_CACHE_PATH):
+    '''
+    Writes the cache of geocoding and weather station lookups to disk
+    Parameters:
+        location_cache (dict): {'country/state/city':location_dict,...}
+        cache_path (str): path to the cache .json
+    '''
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write then rename so a failed run can't leave half a cache behind
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(location_cache, f, indent=2, sort_keys=True)
+    os.replace(temp_path, cache_path)
+    logging.info(f"Saved {len(location_cache)} locations to {cache_path}")
+
+def get_cached_location(location_cache, country, state, city,
+                        cache_ttl_days=30, refresh_cache=False):
+    '''
+    Looks up a city in the location cache
+    Parameters:
+        location_cache (dict): {'country/state/city':location_dict,...}
+        country (str)
+        state (str)
+        city (str)
+        cache_ttl_days (float): maximum age of a usable cache entry
+        refresh_cache (bool): treat every entry as stale
+    Returns:
+        location (dict or None): lat/long, weather station code, and time
+            zone, or None when the city is missing or stale
+    '''
+    location = location_cache.get(location_cache_key(country, state, city))
+    if location is None or refresh_cache:
+        return None
+    age_days = (time.time() - location.get('cached_at', 0)) / 86400
+    if age_days > cache_ttl_days:
+        logging.info(f"Cached location for {city}, {state} is \
+{age_days:.1f} days old, refreshing")
+        return None
+    return location
+
+def invalidate_location_cache(country=None, state=None, city=None,
+                              cache_path=LOCATION_CACHE_PATH):
+    '''
+    Removes entries from the location cache. Any of country, state, or
+        city left as None matches everything, so calling this with no
+        arguments clears the whole cache
+    Parameters:
+        country (str)
+        state (str)
+        city (str)
+        cache_path (str): path to the cache .json
+    Returns:
+        removed (int): the number of entries removed
+    '''
+    location_cache = load_location_cache(cache_path)
+    pattern = [country, state, city]
+    stale_keys = [key for key in location_cache
+                  if all(part is None or part == key_part
+                         for part, key_part in zip(pattern, key.split('/')))]
+    for key in stale_keys:
+        del location_cache[key]
+    save_location_cache(location_cache, cache_path)
+    logging.info(f"Removed {len(stale_keys)} entries from the location cache")
+    return len(stale_keys)
+
 def create_fact_dataframe(bicycle_metadata_item) -> pd.DataFrame:
     '''
     Creates a dataframe that contains information from both the metadata
@@ -101,77 +268,1015 @@ def create_fact_dataframe(bicycle_metadata_item) -> pd.DataFrame:
             the directory they're stored in and API calls
     '''
     logging.info(f'Creating dataframe for {bicycle_metadata_item}')
-    df = pd.read_csv(bicycle_metadata_item['file_path'],
-                     header=0,
-                     names=['date', 'bicycle_count'],
-                     usecols=[0,1],
-                     parse_dates=['date'])
-    df['local_time'] = df['date'].dt.time
-    df['local_date'] = df['date'].dt.date
-    df['timezone'] = bicycle_metadata_item['time_zone']
+    source = counter_source(bicycle_metadata_item['country'],
+                            bicycle_metadata_item['state'],
+                            bicycle_metadata_item['city'])
+    # pandas returns usecols in file order whatever order they're given in,
+    # so the names are put in file order too
+    names = [name for position, name in sorted(zip(
+        source['usecols'], ['date', 'bicycle_count']))]
+    start_offset = bicycle_metadata_item.get('start_offset', 0)
+    if start_offset:
+        # Append-only export, only parse the bytes added since last run
+        with open(bicycle_metadata_item['file_path'], 'rb') as f:
+            f.seek(start_offset)
+            try:
+                df = pd.read_csv(f,
+                                 header=None,
+                                 names=names,
+                                 usecols=source['usecols'],
+                                 dtype=source['dtype'],
+                                 encoding=source['encoding'])
+            except pd.errors.EmptyDataError:
+                df = pd.DataFrame({'date': pd.Series(dtype=str),
+                                   'bicycle_count': pd.Series(dtype='Int32')})
+    else:
+        df = pd.read_csv(bicycle_metadata_item['file_path'],
+                         header=0,
+                         names=names,
+                         usecols=source['usecols'],
+                         dtype=source['dtype'],
+                         encoding=source['encoding'])
+    # an exact format skips pandas' row by row date inference
+    df['date'] = pd.to_datetime(df['date'], format=source['date_format'])
+    watermark = bicycle_metadata_item.get('watermark')
+    if watermark is not None:
+        df = df[df['date'] > pd.Timestamp(watermark)].copy()
     # new UTC-based columns by converting from local time 
-    df['utc_datetime'] = df['date'].dt.tz_localize(
-        bicycle_metadata_item['time_zone'],
-        ambiguous=True, nonexistent='shift_backward').dt.tz_convert('utc').dt.round('H')
-    df['utc_date'] = df['utc_datetime'].dt.date
-    df['utc_time'] = df['utc_datetime'].dt.time
-    df['city'] = bicycle_metadata_item['city']
-    df['state'] = bicycle_metadata_item['state']
-    df['counter_location'] = bicycle_metadata_item['file_path'].stem
-    df['weather_station_code'] = bicycle_metadata_item\
-        ['weather_station_code']
-    df = df[['local_date', 'local_time', 'utc_date', 'utc_time',
-             'city', 'state', 'counter_location', 'weather_station_code',
-             'bicycle_count']]
+    utc_datetime = local_to_utc(df['date'], bicycle_metadata_item['time_zone'])
+    # Only integer keys are staged, the counter's attributes live in
+    # counter_d and dates/times/weather are joined on their ids
+    df = pd.DataFrame({
+        'counter_id': np.full(len(df), bicycle_metadata_item['counter_id'],
+                              dtype='int32'),
+        'date_id': date_keys(df['date']),
+        'time_id': time_keys(df['date']),
+        'utc_date_id': date_keys(utc_datetime),
+        'utc_time_id': time_keys(utc_datetime),
+        'weather_id': weather_keys(
+            bicycle_metadata_item['weather_station_id'], utc_datetime),
+        'bicycle_count': pd.to_numeric(df['bicycle_count'],
+                                       downcast='integer')})
     
     logging.info(f'Dataframe created, shape: {df.shape}')
     return df
     
-def create_output_csv(dataframe, output_name):
+def build_utc_hour_lookup(time_zone, start, end):
+    '''
+    Converts every local hour between two dates to its UTC hour. DST is
+        resolved the same way for every counter: a repeated fall-back hour
+        is read as its first (daylight time) occurrence, and a skipped
+        spring-forward hour is moved back to the last instant before the
+        gap and rounded to the hour
+    Parameters:
+        time_zone (str): e.g. 'America/Los_Angeles'
+        start (Timestamp): first local hour to cover
+        end (Timestamp): last local hour to cover
+    Returns:
+        lookup (Pandas dataframe): indexed by local hour, 'utc_datetime'
+            holds the naive UTC hour, 'ambiguous' and 'nonexistent' flag
+            the hours DST had to be resolved for
+    '''
+    local_hours = pd.date_range(start, end, freq='H')
+    utc_hours = local_hours.tz_localize(time_zone,
+                                        ambiguous=np.ones(len(local_hours),
+                                                          dtype=bool),
+                                        nonexistent='shift_backward')\
+        .tz_convert('utc').round('H').tz_localize(None)
+    repeated = local_hours.tz_localize(time_zone,
+                                       ambiguous='NaT',
+                                       nonexistent='shift_forward').isna()
+    skipped = local_hours.tz_localize(time_zone,
+                                      ambiguous=np.ones(len(local_hours),
+                                                        dtype=bool),
+                                      nonexistent='NaT').isna()
+    lookup = pd.DataFrame({'utc_datetime': utc_hours,
+                           'ambiguous': repeated,
+                           'nonexistent': skipped},
+                          index=local_hours)
+    logging.info(f"Built UTC lookup for {time_zone} from {start} to {end}, \
+{lookup['ambiguous'].sum()} repeated and {lookup['nonexistent'].sum()} \
+skipped hours")
+    return lookup
+
+def utc_hour_lookup(time_zone, start, end):
+    '''
+    Returns a cached local hour -> UTC hour lookup covering at least the
+        given dates, built once per time zone in whole years and only
+        rebuilt when a later file needs a wider span
+    Parameters:
+        time_zone (str)
+        start (Timestamp): earliest local datetime needed
+        end (Timestamp): latest local datetime needed
+    Returns:
+        lookup (Pandas dataframe): see build_utc_hour_lookup
+    '''
+    lookup = _utc_lookups.get(time_zone)
+    if lookup is None or start < lookup.index[0] or end > lookup.index[-1]:
+        first_year = start.year
+        last_year = end.year
+        if lookup is not None:
+            first_year = min(first_year, lookup.index[0].year)
+            last_year = max(last_year, lookup.index[-1].year)
+        lookup = build_utc_hour_lookup(time_zone,
+                                       pd.Timestamp(first_year, 1, 1),
+                                       pd.Timestamp(last_year, 12, 31, 23))
+        _utc_lookups[time_zone] = lookup
+    return lookup
+
+def local_to_utc(local_datetimes, time_zone):
+    '''
+    Converts naive local datetimes to naive UTC datetimes rounded to the
+        hour. Datetimes on the hour are joined to the time zone's cached
+        lookup, anything else (or blank) goes through tz_localize with the
+        same DST rules
+    Parameters:
+        local_datetimes (Pandas series): datetime64 values
+        time_zone (str)
+    Returns:
+        utc_datetimes (Pandas series): aligned with local_datetimes
+    '''
+    utc_datetimes = pd.Series(pd.NaT, index=local_datetimes.index,
+                              dtype='datetime64[ns]')
+    on_the_hour = local_datetimes.notna()\
+        & (local_datetimes == local_datetimes.dt.floor('H'))
+    if on_the_hour.any():
+        hours = local_datetimes[on_the_hour]
+        lookup = utc_hour_lookup(time_zone, hours.min(), hours.max())
+        utc_datetimes[on_the_hour] = lookup['utc_datetime']\
+            .reindex(hours).values
+    off_the_hour = local_datetimes.notna() & ~on_the_hour
+    if off_the_hour.any():
+        utc_datetimes[off_the_hour] = local_datetimes[off_the_hour]\
+            .dt.tz_localize(time_zone,
+                            ambiguous=np.ones(off_the_hour.sum(), dtype=bool),
+                            nonexistent='shift_backward')\
+            .dt.tz_convert('utc').dt.round('H').dt.tz_localize(None).values
+    return utc_datetimes
+
+def date_keys(datetimes):
+    '''
+    Turns datetimes into date_d keys, the date as a YYYYMMDD integer
+    Parameters:
+        datetimes (Pandas series): datetime64 values
+    Returns:
+        date_ids (Pandas series): nullable Int32, blank where the datetime is
+    '''
+    return (datetimes.dt.year * 10000 + datetimes.dt.month * 100
+            + datetimes.dt.day).astype('Int32')
+
+def time_keys(datetimes):
+    '''
+    Turns datetimes into time_d keys, the time of day as an HHMMSS integer
+    Parameters:
+        datetimes (Pandas series): datetime64 values
+    Returns:
+        time_ids (Pandas series): nullable Int32, blank where the datetime is
+    '''
+    return (datetimes.dt.hour * 10000 + datetimes.dt.minute * 100
+            + datetimes.dt.second).astype('Int32')
+
+def weather_keys(weather_station_id, utc_datetimes):
+    '''
+    Builds weather_d keys from a station's surrogate key and the UTC hour,
+        so facts can carry the key of their weather row without looking it
+        up. Stations are WEATHER_KEY_STRIDE hours apart, which lasts until
+        past the year 3000
+    Parameters:
+        weather_station_id (int): from the key registry
+        utc_datetimes (Pandas series): datetime64 values on the hour
+    Returns:
+        weather_ids (Pandas series): nullable Int64
+    '''
+    hours = (utc_datetimes - pd.Timestamp(0)) // pd.Timedelta(hours=1)
+    return (weather_station_id * WEATHER_KEY_STRIDE + hours).astype('Int64')
+
+def key_to_date(key):
+    '''
+    Decodes a YYYYMMDD key (or YYYYMMDDHHMMSS for date and time together)
+    Parameters:
+        key (int)
+    Returns:
+        datetime (datetime.datetime)
+    '''
+    key = str(int(key))
+    return datetime.datetime.strptime(key, '%Y%m%d%H%M%S' if len(key) > 8
+                                      else '%Y%m%d')
+
+def load_key_registry(registry_path=KEY_REGISTRY_PATH):
+    '''
+    Reads the surrogate keys handed out to counters and weather stations
+    Parameters:
+        registry_path (str): path to the registry .json
+    Returns:
+        key_registry (dict): {'counters':{'counter key':counter_dict,...},
+            'weather_stations':{'weather_station_code':id,...}}
+    '''
+    if not os.path.exists(registry_path):
+        return {'counters': {}, 'weather_stations': {}}
+    with open(registry_path) as f:
+        return json.load(f)
+
+def save_key_registry(key_registry, registry_path=KEY_REGISTRY_PATH):
+    '''
+    Writes the key registry to disk
+    Parameters:
+        key_registry (dict): see load_key_registry
+        registry_path (str): path to the registry .json
+    '''
+    os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+    with open(registry_path, 'w') as f:
+        json.dump(key_registry, f, indent=2, sort_keys=True)
+
+def assign_surrogate_keys(bicycle_metadata, key_registry):
+    '''
+    Gives every counter and weather station a stable integer key. Keys
+        already in the registry are kept, new ones continue from the
+        highest key in sorted order, so a counter keeps its id for good and
+        facts can be keyed before anything reaches the warehouse. Adds
+        'counter_id' and 'weather_station_id' to each metadata item
+    Parameters:
+        bicycle_metadata (list): a collection of metadata dictionaries
+        key_registry (dict): output of load_key_registry, updated in place
+    Returns:
+        key_registry (dict)
+    '''
+    counters = key_registry['counters']
+    stations = key_registry['weather_stations']
+    for item in sorted(bicycle_metadata,
+                       key=lambda item: manifest_key(item['file_path'])):
+        key = manifest_key(item['file_path'])
+        if key not in counters:
+            counters[key] = {'counter_id': max(
+                [counter['counter_id'] for counter in counters.values()],
+                default=0) + 1}
+        # attributes can change, e.g. a refreshed weather station lookup
+        counters[key].update({'counter_location': item['file_path'].stem,
+                              'city': item['city'],
+                              'state': item['state'],
+                              'country': item['country'],
+                              'weather_station_code':
+                                  item['weather_station_code'],
+                              'time_zone': item['time_zone']})
+        if item['weather_station_code'] not in stations:
+            stations[item['weather_station_code']] = max(stations.values(),
+                                                         default=0) + 1
+        item['counter_id'] = counters[key]['counter_id']
+        item['weather_station_id'] = stations[item['weather_station_code']]
+    return key_registry
+
+def record_output(output_manifest, output_file, rows, data):
+    '''
+    Adds a write to the output manifest, so control totals never have to
+        re-read the staged files. Appends to the same file accumulate, and
+        the checksum is kept running across them
+    Parameters:
+        output_manifest (dict): {'file_name':entry_dict,...}
+        output_file (str): path of the file that was written
+        rows (int): data rows written
+        data (bytes): the bytes written
+    '''
+    file_name = os.path.basename(output_file)
+    entry = output_manifest.get(file_name)
+    if entry is None:
+        entry = {'table': re.split('-|\.', file_name)[0],
+                 'rows': 0,
+                 'bytes': 0}
+        output_manifest[file_name] = entry
+        _output_hashers[output_file] = hashlib.sha256()
+    hasher = _output_hashers[output_file]
+    hasher.update(data)
+    entry['rows'] += rows
+    entry['bytes'] += len(data)
+    entry['sha256'] = hasher.hexdigest()
+
+def manifest_control_totals(output_manifest, file_extension=None):
+    '''
+    Sums the rows in the output manifest by table, the same shape as
+        source_control_totals but without opening a single staged file
+    Parameters:
+        output_manifest (dict): {'file_name':entry_dict,...}
+        file_extension (str): only count files ending with this, e.g.
+            '.parquet'. None counts everything
+    Returns:
+        source_counts (dict): {'table_name':row_count,...}
+    '''
+    source_counts = {}
+    for file_name, entry in output_manifest.items():
+        if file_extension and not file_name.endswith(file_extension):
+            continue
+        source_counts[entry['table']] = source_counts.get(entry['table'], 0)\
+            + entry['rows']
+    return source_counts
+
+def save_output_manifest(output_manifest,
+                         manifest_path=OUTPUT_MANIFEST_PATH):
+    '''
+    Writes the output manifest to disk next to the other run state
+    Parameters:
+        output_manifest (dict): {'file_name':entry_dict,...}
+        manifest_path (str): path to the manifest .json
+    '''
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(output_manifest, f, indent=2, sort_keys=True)
+    logging.info(f"Saved output manifest for {len(output_manifest)} files")
+
+def create_output_csv(dataframe, output_name, output_manifest=None):
     '''
     Creates (or appends to) a .csv file in the specified location
     Parameters:
         dataframe (Pandas dataframe)
         output_name (str): the full path of the to-be-created .csv
+        output_manifest (dict): when given, the rows, bytes, and checksum
+            of the write are recorded in it
     '''
-    output_destination = os.path.join(ROOT_DIR, 'data\\output')
+    output_destination = os.path.join(ROOT_DIR, 'data/output')
     logging.info(f'Creating (or appending) data to {output_name} in folder\
                  {output_destination}')
-    if os.path.exists(os.path.join(output_destination, output_name)):
-        dataframe.to_csv(os.path.join(output_destination, output_name),
-                        mode='a',
-                        header=False,
-                        index=False)
+    output_file = os.path.join(output_destination, output_name)
+    header = not os.path.exists(output_file)
+    # serialized once so the same bytes are written and recorded
+    data = dataframe.to_csv(index=False, header=header).encode('utf-8')
+    with open(output_file, 'ab') as f:
+        f.write(data)
+    if output_manifest is not None:
+        record_output(output_manifest, output_file, len(dataframe), data)
+
+def create_output_parquet(dataframe, output_name, output_manifest=None):
+    '''
+    Creates a typed, snappy-compressed .parquet file in the specified
+        location. Parquet files can't be appended to, so multi-part
+        outputs write one file per part instead
+    Parameters:
+        dataframe (Pandas dataframe)
+        output_name (str): the full path of the to-be-created .parquet
+        output_manifest (dict): when given, the rows, bytes, and checksum
+            of the file are recorded in it
+    '''
+    output_destination = os.path.join(ROOT_DIR, 'data/output')
+    logging.info(f'Creating {output_name} in folder {output_destination}')
+    dataframe = dataframe.copy()
+    for col in dataframe.columns:
+        # time objects would become parquet TIME, the tables store them as
+        # VARCHAR(9) strings
+        if dataframe[col].dtype == object and not dataframe.empty\
+                and isinstance(dataframe[col].iloc[0], datetime.time):
+            dataframe[col] = dataframe[col].astype(str)
+        # categoricals are stored as their plain values so every file of a
+        # table has the same schema
+        elif pd.api.types.is_categorical_dtype(dataframe[col]):
+            dataframe[col] = dataframe[col].astype(
+                dataframe[col].cat.categories.dtype)
+        # narrowed integers would change from file to file with the size
+        # of the counts, they're written as wide as the column they're
+        # loaded into
+        elif pd.api.types.is_integer_dtype(dataframe[col]):
+            width = 64 if col in bigint_columns else 32
+            dataframe[col] = dataframe[col].astype(
+                f'Int{width}' if pd.api.types.is_extension_array_dtype(
+                    dataframe[col]) else f'int{width}')
+        # datetimes without a time of day are DATE columns, the same way
+        # to_csv writes them
+        elif pd.api.types.is_datetime64_dtype(dataframe[col])\
+                and (dataframe[col].dropna().dt.normalize()
+                     == dataframe[col].dropna()).all():
+            dataframe[col] = dataframe[col].dt.date
+    buffer = io.BytesIO()
+    dataframe.to_parquet(buffer,
+                         engine='pyarrow',
+                         compression='snappy',
+                         index=False)
+    data = buffer.getvalue()
+    output_file = os.path.join(output_destination, output_name)
+    with open(output_file, 'wb') as f:
+        f.write(data)
+    if output_manifest is not None:
+        # a rewrite replaces the file, so it starts a fresh entry
+        output_manifest.pop(os.path.basename(output_file), None)
+        record_output(output_manifest, output_file, len(dataframe), data)
+
+def stream_to_warehouse(dataframe, output_stem, warehouse,
+                        output_manifest=None):
+    '''
+    Loads a dataframe straight into its table with COPY FROM STDIN instead
+        of staging a file. At most warehouse['buffer_rows'] rows are
+        serialized at a time, and since every stage shares the connection,
+        each COPY holds warehouse['lock']. Nothing is committed, the load
+        stage commits every table at once
+    Parameters:
+        dataframe (Pandas dataframe)
+        output_stem (str): the name the staged file would have had, without
+            its extension, e.g. bicycle_fact-0. The table is its prefix
+        warehouse (dict): 'con', 'lock', 'buffer_rows', and 'target_suffix'
+            (e.g. '_stage' to load a merge's staging table)
+        output_manifest (dict): where to record the rows, bytes, and
+            checksum streamed, under output_stem
+    '''
+    stream_name = os.path.basename(output_stem)
+    table_name = re.split('-|\.', stream_name)[0]
+    columns = staged_columns[table_name]
+    query = stdin_copy.format(
+        target_table=table_name + warehouse.get('target_suffix', ''),
+        column_list=', '.join(columns))
+    buffer_rows = warehouse.get('buffer_rows') or max(len(dataframe), 1)
+    if output_manifest is not None and dataframe.empty:
+        record_output(output_manifest, stream_name, 0, b'')
+    for start in range(0, len(dataframe), buffer_rows):
+        chunk = dataframe.iloc[start:start + buffer_rows]
+        data = chunk.to_csv(index=False, header=False, columns=columns)\
+            .encode('utf-8')
+        with warehouse['lock'], warehouse['con'].cursor() as cur:
+            cur.copy_expert(query, io.BytesIO(data))
+        if output_manifest is not None:
+            record_output(output_manifest, stream_name, len(chunk), data)
+    logging.info(f"Streamed {len(dataframe)} rows from {stream_name} into \
+{table_name}")
+
+def create_output_file(dataframe, output_stem, output_format='csv',
+                       output_manifest=None, warehouse=None):
+    '''
+    Stages a dataframe in whichever format the pipeline is running with
+    Parameters:
+        dataframe (Pandas dataframe)
+        output_stem (str): the file name without its extension
+        output_format (str): 'csv' or 'parquet'
+        output_manifest (dict): where to record the write
+        warehouse (dict): when given, the rows are streamed into the
+            warehouse instead, see stream_to_warehouse
+    '''
+    if warehouse is not None:
+        stream_to_warehouse(dataframe, output_stem, warehouse,
+                            output_manifest)
+    elif output_format == 'parquet':
+        create_output_parquet(dataframe, f'{output_stem}.parquet',
+                              output_manifest)
+    elif output_format == 'csv':
+        create_output_csv(dataframe, f'{output_stem}.csv', output_manifest)
+    else:
+        raise ValueError(f"Unknown output format '{output_format}'")
+
+def apply_quality_gate(dataframe, source_name, quality_gate='report',
+                       seen_hashes=None, quality_report=None):
+    '''
+    Runs the quality checks on a dataframe before it's staged (see
+        quality_checks.quality_suite) and acts on the rows that fail them
+    Parameters:
+        dataframe (Pandas dataframe)
+        source_name (str): the table and what it's built from, e.g.
+            'bicycle_fact-3' or 'weather_d-72793'
+        quality_gate (str): 'report' only logs and records the failures,
+            'fail' raises before a bad row is staged, and 'quarantine'
+            stages the rows that pass and appends the rest to
+            data/quarantine/{source_name}.csv
+        seen_hashes (dict): see quality_checks.run_quality_checks
+        quality_report (dict): where to record the results, chunks with
+            the same source_name add up
+    Returns:
+        dataframe (Pandas dataframe): the rows to stage
+    '''
+    if quality_gate not in ('report', 'fail', 'quarantine'):
+        raise ValueError(f"Unknown quality gate '{quality_gate}'")
+    table_name = source_name.split('-')[0]
+    results, failed = run_quality_checks(dataframe, table_name,
+                                         seen_hashes=seen_hashes,
+                                         sample_size=QUALITY_SAMPLE_ROWS)
+    failed_rows = int(failed.sum())
+    if quality_report is not None:
+        entry = quality_report.setdefault(source_name, {
+            'table': table_name, 'rows': 0, 'failed_rows': 0,
+            'quarantined_rows': 0,
+            'checks': [dict(result, failed=0, sample=[])
+                       for result in results]})
+        entry['rows'] += len(dataframe)
+        entry['failed_rows'] += failed_rows
+        for check, result in zip(entry['checks'], results):
+            check['failed'] += result['failed']
+            check['sample'] = (check['sample']
+                               + result['sample'])[:QUALITY_SAMPLE_ROWS]
+    if not failed_rows:
+        return dataframe
+    for result in results:
+        if result['failed']:
+            logging.info(f"{result['kind']} check on {source_name} \
+{result['columns']}: {result['failed']} rows failed, e.g. \
+{result['sample'][:1]}")
+    if quality_gate == 'fail':
+        raise ValueError(f"{failed_rows} rows of {source_name} failed the \
+quality gate, see the log for the checks")
+    if quality_gate == 'quarantine':
+        quarantine_path = os.path.join(ROOT_DIR, 'data/quarantine')
+        os.makedirs(quarantine_path, exist_ok=True)
+        create_output_csv(dataframe[failed], os.path.join(
+            quarantine_path, f'{source_name}.csv'))
+        if quality_report is not None:
+            quality_report[source_name]['quarantined_rows'] += failed_rows
+        return dataframe[~failed]
+    return dataframe
+
+def build_fact_dataframe(indexed_metadata_item, quality_gate=None):
+    '''
+    Builds and summarizes the fact dataframe for a single counter file.
+        Kept at module level so it can be pickled and handed to a process
+        pool
+    Parameters:
+        indexed_metadata_item (tuple): (i, bicycle_metadata_item)
+        quality_gate (str): when given, the dataframe goes through
+            apply_quality_gate before it's returned
+    Returns:
+        (i, dataframe, fact_summary) (tuple), the summary also holds the
+            build's 'seconds' and source 'bytes_in', and the gate's
+            'quality' report
+    '''
+    i, item = indexed_metadata_item
+    started = time.perf_counter()
+    df = create_fact_dataframe(item)
+    fact_summary = summarize_fact_dataframe(df)
+    if quality_gate:
+        # the watermark still covers quarantined rows, they're not read
+        # again next run
+        fact_summary['quality'] = {}
+        df = apply_quality_gate(df, f'bicycle_fact-{i}', quality_gate,
+                                quality_report=fact_summary['quality'])
+        fact_summary['rows'] = len(df)
+    # per-file breakdown for the run report, appended files are only
+    # read from their start offset
+    fact_summary['seconds'] = round(time.perf_counter() - started, 3)
+    fact_summary['bytes_in'] = os.path.getsize(item['file_path'])\
+        - item.get('start_offset', 0)
+    return i, df, fact_summary
+
+def build_fact_csv(indexed_metadata_item, output_format='csv',
+                   quality_gate=None):
+    '''
+    Builds the fact dataframe for a single counter file and stages it as
+        its own bicycle_fact-{i} file. Kept at module level so it can be
+        pickled and handed to a process pool
+    Parameters:
+        indexed_metadata_item (tuple): (i, bicycle_metadata_item)
+        output_format (str): 'csv' or 'parquet'
+        quality_gate (str): see apply_quality_gate, None skips it
+    Returns:
+        (i, row_count, fact_summary, output_manifest) (tuple), see
+            build_fact_dataframe for the summary
+    '''
+    i, df, fact_summary = build_fact_dataframe(indexed_metadata_item,
+                                               quality_gate)
+    output_manifest = {}
+    if not df.empty:
+        create_output_file(df, f'bicycle_fact-{i}', output_format,
+                           output_manifest)
+    return i, len(df), fact_summary, output_manifest
+
+def summarize_fact_dataframe(dataframe):
+    '''
+    Finds the latest local date/time and the UTC date range in a fact
+        dataframe
+    Parameters:
+        dataframe (Pandas dataframe): output of create_fact_dataframe
+    Returns:
+        fact_summary (dict): 'rows', 'watermark' (ISO formatted local
+            datetime), 'utc_date_min' and 'utc_date_max' (ISO dates), the
+            last three None if the dataframe is empty
+    '''
+    if dataframe.empty:
+        return {'rows': 0, 'watermark': None, 'utc_date_min': None,
+                'utc_date_max': None}
+    # YYYYMMDDHHMMSS, so the latest key is the latest local datetime
+    local_keys = dataframe['date_id'].astype('Int64') * 1000000\
+        + dataframe['time_id']
+    return {'rows': len(dataframe),
+            'watermark': key_to_date(local_keys.max()).isoformat(),
+            'utc_date_min': key_to_date(dataframe['utc_date_id'].min())\
+                .date().isoformat(),
+            'utc_date_max': key_to_date(dataframe['utc_date_id'].max())\
+                .date().isoformat()}
+
+def build_fact_csvs(bicycle_metadata, workers=1, output_format='csv',
+                    output_manifest=None, warehouse=None, quality_gate=None):
+    '''
+    Builds and stages the fact .csv's for every counter file, either one
+        after the other or fanned out to a pool of worker processes. Each
+        counter gets a fixed index up front, so file names and row counts
+        don't depend on which worker finishes first
+    Parameters:
+        bicycle_metadata (list): a collection of metadata dictionaries
+        workers (int): number of worker processes, 1 runs serially
+        output_format (str): 'csv' or 'parquet'
+        output_manifest (dict): the workers' writes are recorded in it
+        warehouse (dict): when given, the workers only build the
+            dataframes and each one is streamed into the warehouse as it
+            comes back, see stream_to_warehouse
+        quality_gate (str): see apply_quality_gate, None skips it
+    Returns:
+        fact_counts (dict): {'bicycle_fact-{i}.{output_format}':row_count,...},
+            without the extension when streamed
+        fact_summaries (dict): {'source file path':fact_summary,...}, see
+            summarize_fact_dataframe
+    '''
+    # Items flagged by plan_incremental_ingest keep their index but are
+    # not rebuilt
+    indexed_metadata = [(i, item) for i, item in enumerate(bicycle_metadata)
+                        if not item.get('unchanged')]
+    if warehouse is not None:
+        streamed = {}
+        def finish(result):
+            # the connection can't leave this process, so the rows are
+            # streamed here while the workers build the next ones
+            i, df, fact_summary = result
+            if not df.empty:
+                stream_to_warehouse(df, f'bicycle_fact-{i}', warehouse,
+                                    streamed)
+            return i, len(df), fact_summary, streamed
+        build = functools.partial(build_fact_dataframe,
+                                  quality_gate=quality_gate)
+    else:
+        finish = None
+        build = functools.partial(build_fact_csv, output_format=output_format,
+                                  quality_gate=quality_gate)
+    if workers > 1:
+        logging.info(f"Building {len(indexed_metadata)} fact files with \
+{workers} workers")
+        # forking while the scheduler's threads hold locks can deadlock
+        # the workers, so they're started fresh
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = [finish(result) if finish else result
+                       for result in executor.map(build, indexed_metadata)]
     else:
-        dataframe.to_csv(os.path.join(output_destination, output_name),
-                        index=False)
+        results = [finish(build(item)) if finish else build(item)
+                   for item in indexed_metadata]
+    extension = f'.{output_format}' if warehouse is None else ''
+    fact_counts = {f'bicycle_fact-{i}{extension}': count
+                   for i, count, summary, written in results if count}
+    fact_summaries = {str(bicycle_metadata[i]['file_path']): summary
+                      for i, count, summary, written in results}
+    if output_manifest is not None:
+        for i, count, summary, written in results:
+            output_manifest.update(written)
+    logging.info(f"Fact files built: {fact_counts}")
+    return fact_counts, fact_summaries
+
+def station_utc_date_ranges(bicycle_metadata, fact_summaries,
+                            ingest_manifest=None):
+    '''
+    Works out which UTC dates each weather station needs to cover, based
+        on the facts built this run and, for incremental runs, the files
+        already ingested by earlier runs
+    Parameters:
+        bicycle_metadata (list): a collection of metadata dictionaries
+        fact_summaries (dict): output of build_fact_csvs
+        ingest_manifest (dict): output of load_ingest_manifest
+    Returns:
+        utc_date_ranges (dict): {'weather_station_code':(min_date, max_date),
+            ...} with ISO formatted dates
+    '''
+    utc_date_ranges = {}
+    for item in bicycle_metadata:
+        summaries = [fact_summaries.get(str(item['file_path']), {})]
+        if ingest_manifest:
+            summaries.append(ingest_manifest.get(
+                manifest_key(item['file_path']), {}))
+        min_dates = [summary['utc_date_min'] for summary in summaries
+                     if summary.get('utc_date_min')]
+        max_dates = [summary['utc_date_max'] for summary in summaries
+                     if summary.get('utc_date_max')]
+        if not min_dates:
+            continue
+        station = item['weather_station_code']
+        low, high = utc_date_ranges.get(station, (min(min_dates),
+                                                  max(max_dates)))
+        utc_date_ranges[station] = (min([low] + min_dates),
+                                    max([high] + max_dates))
+    logging.info(f"UTC date ranges needed per weather station: \
+{utc_date_ranges}")
+    return utc_date_ranges
+
+def file_fingerprint(file, prefix_size=None):
+    '''
+    Hashes a file in a single pass. When prefix_size is given, the first
+        prefix_size bytes are hashed separately as well, which tells us
+        whether a file has only been appended to since it was last seen
+    Parameters:
+        file (str): a file path
+        prefix_size (int): size of the file when it was last ingested
+    Returns:
+        fingerprint (dict): size, sha256, and (when requested)
+            prefix_sha256 and whether the prefix ended on a full line
+    '''
+    full_hash = hashlib.sha256()
+    prefix_hash = hashlib.sha256() if prefix_size is not None else None
+    position = 0
+    prefix_last_byte = b''
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            full_hash.update(block)
+            if prefix_hash is not None and position < prefix_size:
+                prefix_block = block[:prefix_size - position]
+                prefix_hash.update(prefix_block)
+                if prefix_block:
+                    prefix_last_byte = prefix_block[-1:]
+            position += len(block)
+    fingerprint = {'size': position, 'sha256': full_hash.hexdigest()}
+    if prefix_hash is not None:
+        fingerprint['prefix_sha256'] = prefix_hash.hexdigest()
+        fingerprint['prefix_ends_line'] = prefix_last_byte == b'\n'
+    return fingerprint
+
+def load_ingest_manifest(manifest_path=INGEST_MANIFEST_PATH):
+    '''
+    Reads the manifest of previously ingested counter files
+    Parameters:
+        manifest_path (str): path to the manifest .json
+    Returns:
+        ingest_manifest (dict): {'relative source path':entry_dict,...}
+    '''
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_ingest_manifest(ingest_manifest, manifest_path=INGEST_MANIFEST_PATH):
+    '''
+    Writes the manifest of ingested counter files to disk
+    Parameters:
+        ingest_manifest (dict): {'relative source path':entry_dict,...}
+        manifest_path (str): path to the manifest .json
+    '''
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(ingest_manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+    logging.info(f"Saved ingest manifest for {len(ingest_manifest)} files")
+
+def manifest_key(file_path):
+    '''
+    Builds the key a source file is tracked under in the ingest manifest
+    Parameters:
+        file_path (path-like)
+    Returns:
+        key (str): the file path relative to the project root
+    '''
+    return Path(os.path.relpath(file_path, ROOT_DIR)).as_posix()
+
+def plan_incremental_ingest(bicycle_metadata, ingest_manifest):
+    '''
+    Compares each counter file against the ingest manifest and marks up its
+        metadata dictionary with what still needs processing:
+        - unchanged files get 'unchanged' and are skipped entirely
+        - files that were only appended to get 'start_offset' so just the
+          new bytes are parsed. The bytes themselves are the watermark
+          here, since exports aren't always in date order
+        - files rewritten in place get the 'watermark' only, so they're
+          re-read but only rows newer than the last run are kept
+        - new files are processed in full
+    Parameters:
+        bicycle_metadata (list): a collection of metadata dictionaries
+        ingest_manifest (dict): output of load_ingest_manifest
+    Returns:
+        fingerprints (dict): {'relative source path':fingerprint,...} to be
+            recorded once the run succeeds
+    '''
+    fingerprints = {}
+    for item in bicycle_metadata:
+        key = manifest_key(item['file_path'])
+        entry = ingest_manifest.get(key)
+        fingerprint = file_fingerprint(item['file_path'],
+                                       entry['size'] if entry else None)
+        fingerprints[key] = fingerprint
+        if entry is None:
+            logging.info(f"New source file {key}")
+        elif (fingerprint['size'] == entry['size']
+              and fingerprint['sha256'] == entry['sha256']):
+            logging.info(f"Skipping unchanged source file {key}")
+            item['unchanged'] = True
+        elif (fingerprint['size'] > entry['size']
+              and fingerprint['prefix_sha256'] == entry['sha256']
+              and fingerprint['prefix_ends_line']):
+            logging.info(f"Source file {key} was appended to, reading from \
+byte {entry['size']}")
+            item['start_offset'] = entry['size']
+        else:
+            logging.info(f"Source file {key} was rewritten, keeping rows \
+after {entry['watermark']}")
+            item['watermark'] = entry['watermark']
+    return fingerprints
+
+def update_ingest_manifest(ingest_manifest, fingerprints, fact_summaries,
+                           bicycle_metadata):
+    '''
+    Records what this run ingested. Only call once the delta has been
+        loaded, so a failed run is picked up again next time
+    Parameters:
+        ingest_manifest (dict): output of load_ingest_manifest
+        fingerprints (dict): output of plan_incremental_ingest
+        fact_summaries (dict): output of build_fact_csvs
+        bicycle_metadata (list): a collection of metadata dictionaries
+    Returns:
+        ingest_manifest (dict): the updated manifest
+    '''
+    ingested_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    for item in bicycle_metadata:
+        if item.get('unchanged'):
+            continue
+        key = manifest_key(item['file_path'])
+        entry = ingest_manifest.get(key, {'rows': 0})
+        summary = fact_summaries.get(str(item['file_path']), {})
+        latest = [value for value in [entry.get('watermark'),
+                                      summary.get('watermark')] if value]
+        earliest_utc = [value for value in [entry.get('utc_date_min'),
+                                            summary.get('utc_date_min')]
+                        if value]
+        latest_utc = [value for value in [entry.get('utc_date_max'),
+                                          summary.get('utc_date_max')]
+                      if value]
+        ingest_manifest[key] = {
+            'size': fingerprints[key]['size'],
+            'sha256': fingerprints[key]['sha256'],
+            'watermark': max(latest, default=None),
+            'utc_date_min': min(earliest_utc, default=None),
+            'utc_date_max': max(latest_utc, default=None),
+            'rows': entry['rows'] + summary.get('rows', 0),
+            'last_ingested': ingested_at}
+    return ingest_manifest
+
+def remove_staged_files(source_path, table_name):
+    '''
+    Deletes the staged files for a table so the next build starts clean
+        instead of appending to the last run's output
+    Parameters:
+        source_path (str): the staging folder
+        table_name (str): the file prefix, e.g. 'bicycle_fact'
+    '''
+    if not os.path.isdir(source_path):
+        return
+    for file in os.listdir(source_path):
+        if re.split('-|\.', file)[0] == table_name:
+            logging.info(f"Removing previously staged file {file}")
+            os.remove(os.path.join(source_path, file))
+
+def create_download_session(pool_size=4, retries=3, backoff_factor=0.5):
+    '''
+    Creates a requests session that reuses connections and retries failed
+        requests with an exponential backoff
+    Parameters:
+        pool_size (int): connections kept open per host
+        retries (int): attempts after the first one fails
+        backoff_factor (float): seconds to wait before the first retry,
+            doubling after that
+    Returns:
+        session (requests.Session)
+    '''
+    retry = Retry(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-def download_weather_data(bicycle_metadata):
+def download_weather_file(session, url, output_file, chunk_size=1024 * 1024):
+    '''
+    Downloads a file unless the server says it hasn't changed since the
+        last download. The ETag and Last-Modified headers are kept beside
+        the file in {output_file}.headers.json, and the body is streamed to
+        disk so it's never held in memory all at once
+    Parameters:
+        session (requests.Session)
+        url (str)
+        output_file (str): where to save the file
+        chunk_size (int): bytes written per chunk
+    Returns:
+        downloaded (bool): False if the file was unchanged
+    '''
+    headers_file = output_file + '.headers.json'
+    request_headers = {}
+    if os.path.exists(output_file) and os.path.exists(headers_file):
+        with open(headers_file) as f:
+            cached_headers = json.load(f)
+        if cached_headers.get('etag'):
+            request_headers['If-None-Match'] = cached_headers['etag']
+        if cached_headers.get('last_modified'):
+            request_headers['If-Modified-Since'] =\
+                cached_headers['last_modified']
+
+    with session.get(url, headers=request_headers, stream=True,
+                     timeout=60) as r:
+        if r.status_code == 304:
+            logging.info(f"{url} unchanged, skipping download")
+            return False
+        r.raise_for_status()
+        # write then rename so an interrupted download isn't mistaken for
+        # a complete one
+        temp_file = output_file + '.part'
+        with open(temp_file, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+        os.replace(temp_file, output_file)
+        with open(headers_file, 'w') as f:
+            json.dump({'etag': r.headers.get('ETag'),
+                       'last_modified': r.headers.get('Last-Modified')}, f)
+    logging.info(f"Downloaded {url} to {output_file}")
+    return True
+
+def download_weather_data(bicycle_metadata,
+                          base_url='https://bulk.meteostat.net/v2/hourly',
+                          max_workers=4, retries=3, backoff_factor=0.5):
     '''
     Retrieves data from the meteostat API based on the nearby weather
-        station codes found in prior processing
+        station codes found in prior processing. Stations are fetched
+        concurrently over a shared session and unchanged files are skipped
     Parameters:
         bicycle_metadata (list): A list of dictionaries containing metadata
             related to the source files for bicycle counts
+        base_url (str): where the hourly .csv.gz files live, can point to
+            a local server for testing
+        max_workers (int): number of downloads running at once
+        retries (int): attempts after the first one fails
+        backoff_factor (float): seconds to wait before the first retry
+    Returns:
+        download_results (dict): {'station':True if downloaded,...}
     '''
-    logging.info(f"Fetching weather data for the weather stations below:")
+    logging.info("Fetching weather data for the weather stations below:")
     unique_weather_stations = set()
     for item in bicycle_metadata:
         unique_weather_stations.add(item['weather_station_code'])
     logging.info(unique_weather_stations)
     
-    for station in unique_weather_stations:
-        url = f"https://bulk.meteostat.net/v2/hourly/{station}.csv.gz"
-        output_destination = os.path.join(ROOT_DIR, 'data/download')
-        output_file = os.path.join(output_destination, url.split('/')[-1])
-        with open(output_file, 'wb') as f:
-            r = requests.get(url)
-            f.write(r.content)
+    output_destination = os.path.join(ROOT_DIR, 'data/download')
+    os.makedirs(output_destination, exist_ok=True)
+    session = create_download_session(max_workers, retries, backoff_factor)
+    with session, concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = {}
+        for station in sorted(unique_weather_stations):
+            url = f"{base_url.rstrip('/')}/{station}.csv.gz"
+            output_file = os.path.join(output_destination,
+                                       url.split('/')[-1])
+            futures[station] = executor.submit(download_weather_file,
+                                               session, url, output_file)
+        # .result() re-raises the first failed download
+        download_results = {station: future.result()
+                            for station, future in futures.items()}
+    logging.info(f"Downloaded {sum(download_results.values())} of \
+{len(download_results)} weather files, the rest were unchanged")
+    return download_results
+
+def transform_weather_chunk(dataframe, weather_station_code,
+                            weather_station_id):
+    '''
+    Applies the weather_d transformations to a (piece of a) meteostat
+        dataframe
+    Parameters:
+        dataframe (Pandas dataframe): raw meteostat rows
+        weather_station_code (str)
+        weather_station_id (int): the station's key from the key registry
+    Returns:
+        dataframe (Pandas dataframe)
+    '''
+    dataframe.insert(0, 'weather_id', weather_keys(
+        weather_station_id,
+        pd.to_datetime(dataframe['utc_date'], format='%Y-%m-%d')
+        + pd.to_timedelta(dataframe['utc_hour'], unit='h')))
+    dataframe['weather_station_code'] = weather_station_code
+    dataframe['utc_hour'] = dataframe['utc_hour'].astype(str).str.zfill(2)\
+        + ':00:00'
+    return dataframe
 
-def transform_weather_data():
+def transform_weather_data(chunk_size=None, utc_date_ranges=None,
+                           output_format='csv', output_manifest=None,
+                           station_ids=None, warehouse=None,
+                           quality_gate=None, quality_report=None):
     '''
     Reads the compressed weather .csv files, creates dataframes, and then
         creates (or appends to) a .csv data file
+    Parameters:
+        chunk_size (int): when set, each file is decompressed and written
+            this many rows at a time so memory use doesn't grow with the
+            length of a station's history. None reads each file whole
+        utc_date_ranges (dict): output of station_utc_date_ranges. When
+            given, stations without facts are skipped and rows outside
+            their station's fact dates are dropped before being written
+        output_format (str): 'csv' appends every chunk to weather_d-{i}.csv,
+            'parquet' writes each chunk as weather_d-{i}-{part}.parquet
+        output_manifest (dict): where to record each write
+        station_ids (dict): {'weather_station_code':weather_station_id,...},
+            defaults to the key registry's. Stations without a key have no
+            facts and are skipped
+        warehouse (dict): when given, each chunk is streamed into the
+            warehouse instead of written, see stream_to_warehouse
+        quality_gate (str): when given, each chunk goes through
+            apply_quality_gate before it's written, duplicates are looked
+            for across all the chunks of a file
+        quality_report (dict): where the gate records its results
+    Returns:
+        weather_date_ranges (dict): {'weather_station_code':(min_date,
+            max_date),...}, ISO formatted UTC dates of the rows written
     '''
     download_path = os.path.join(ROOT_DIR, 'data/download')
     output_destination = os.path.join(ROOT_DIR, 'data/output')
@@ -180,62 +1285,811 @@ def transform_weather_data():
             'snow_mm', 'wind_direction_deg', 'avg_wind_spd_kmh',
             'peak_wind_gust_kmh', 'air_pressure_hpa',
             'hourly_sunshine_min', 'weather_condition_code']
+    # Pinned so every chunk of a file is written the same way, otherwise a
+    # chunk without any blanks would write 5 where the rest write 5.0.
+    # weather_condition_code is a code loaded into a VARCHAR, kept as text
+    # so it's neither written as 3.0 nor staged as a Parquet DOUBLE
+    col_dtypes = {col: 'float64' for col in col_names[2:-1]}
+    col_dtypes['weather_condition_code'] = 'string'
+    if station_ids is None:
+        station_ids = load_key_registry()['weather_stations']
+    weather_date_ranges = {}
     for root, dir, files in os.walk(download_path):
         i=0
-        for file in files:
+        for file in sorted(files):
             if file.endswith('.gz'):
-                df = pd.read_csv(os.path.join(root, file),
-                                compression='gzip',
-                                names=col_names)
-                df['weather_station_code'] = file.split('.')[0]
-                df['utc_hour'] = df['utc_hour'].astype(str).str.zfill(2)\
-                    + ':00:00'
-                logging.info(f"Dataframe created, shape: {df.shape}")
-                create_output_csv(df, os.path.join(output_destination, f'weather_d-{i}.csv'))
-                i += 1
-
-def copy_to_s3(source_path, s3_bucket):
+                station = file.split('.')[0]
+                if station not in station_ids:
+                    logging.info(f"No counters use station {station}, \
+skipping {file}")
+                    continue
+                if utc_date_ranges is not None:
+                    if station not in utc_date_ranges:
+                        logging.info(f"No facts use station {station}, \
+skipping {file}")
+                        continue
+                    low, high = utc_date_ranges[station]
+                reader = pd.read_csv(os.path.join(root, file),
+                                     compression='gzip',
+                                     names=col_names,
+                                     dtype=col_dtypes,
+                                     chunksize=chunk_size)
+                if chunk_size is None:
+                    reader = [reader]
+                rows = 0
+                part = 0
+                seen_hashes = {}
+                for df in reader:
+                    if utc_date_ranges is not None:
+                        # ISO dates compare correctly as strings
+                        df = df[(df['utc_date'] >= low)
+                                & (df['utc_date'] <= high)].copy()
+                        if df.empty:
+                            continue
+                    df = transform_weather_chunk(df, station,
+                                                 station_ids[station])
+                    if quality_gate:
+                        df = apply_quality_gate(df, f'weather_d-{station}',
+                                                quality_gate, seen_hashes,
+                                                quality_report)
+                        if df.empty:
+                            continue
+                    # ISO dates compare correctly as strings
+                    dates = [df['utc_date'].min(), df['utc_date'].max()]
+                    if station in weather_date_ranges:
+                        dates += weather_date_ranges[station]
+                    weather_date_ranges[station] = (min(dates), max(dates))
+                    if warehouse is not None:
+                        stream_to_warehouse(df, f'weather_d-{i}', warehouse,
+                                            output_manifest)
+                    elif output_format == 'parquet':
+                        # typed dates instead of ISO strings
+                        df['utc_date'] = pd.to_datetime(df['utc_date']).dt.date
+                        create_output_parquet(df, os.path.join(
+                            output_destination,
+                            f'weather_d-{i}-{part}.parquet'),
+                            output_manifest)
+                    else:
+                        create_output_csv(df, os.path.join(
+                            output_destination, f'weather_d-{i}.csv'),
+                            output_manifest)
+                    rows += len(df)
+                    part += 1
+                logging.info(f"Weather data for {file} written, rows: {rows}")
+                if rows:
+                    i += 1
+    return weather_date_ranges
+
+def generate_date_dimension(dates):
+    '''
+    Builds the date_d rows for a set of days, with the columns of
+        sql_queries.date_dimension_create
+    Parameters:
+        dates (DatetimeIndex): the days, e.g. from pd.date_range
+    Returns:
+        date_d (Pandas dataframe)
+    '''
+    # days of the week run from Sunday (1) to Saturday (7)
+    sunday_based = (dates.dayofweek + 1) % 7
+    # weeks start on Sunday, and the days before a year's first Sunday
+    # still belong to the last week of the year before
+    week_start = dates - pd.to_timedelta(sunday_based, unit='D')
+    return pd.DataFrame({
+        'date_id': dates.year * 10000 + dates.month * 100 + dates.day,
+        'date': dates,
+        'year': dates.year,
+        'month': dates.month_name(),
+        'month_of_year': dates.month.astype(str).str.zfill(2),
+        'day_of_month': dates.day,
+        'day': dates.day_name(),
+        'day_of_week': sunday_based + 1,
+        'weekend': np.where(dates.dayofweek >= 5, 'Weekend', 'Weekday'),
+        'day_of_year': dates.dayofyear,
+        'week_of_year': ((week_start.dayofyear + 6) // 7).astype(str)\
+            .str.zfill(2),
+        'quarter': dates.quarter,
+        'previous_day': dates - pd.Timedelta(days=1),
+        'next_day': dates + pd.Timedelta(days=1)})
+
+def generate_time_dimension():
+    '''
+    Builds the time_d rows, one per hour of the day, with the columns of
+        sql_queries.time_dimension_create
+    Returns:
+        time_d (Pandas dataframe)
+    '''
+    hours = np.arange(24)
+    return pd.DataFrame({'time_id': hours * 10000,
+                         'fulltime': [f'{hour:02d}:00:00' for hour in hours],
+                         'hour': hours,
+                         'ampm': np.where(hours < 12, 'AM', 'PM')})
+
+def generate_counter_dimension(key_registry):
+    '''
+    Builds the counter_d rows from the key registry, so counters whose
+        files didn't change this run are still included
+    Parameters:
+        key_registry (dict): output of assign_surrogate_keys
+    Returns:
+        counter_d (Pandas dataframe)
+    '''
+    columns = ['counter_id', 'counter_location', 'city', 'state', 'country',
+               'weather_station_code', 'time_zone']
+    return pd.DataFrame(list(key_registry['counters'].values()),
+                        columns=columns).sort_values('counter_id')
+
+def stage_counter_dimension(source_path, key_registry, output_format='csv',
+                            output_manifest=None, warehouse=None):
+    '''
+    Stages counter_d, replacing the last run's file
+    Parameters:
+        source_path (str): the staging folder
+        key_registry (dict): output of assign_surrogate_keys
+        output_format (str): 'csv' or 'parquet'
+        output_manifest (dict): where to record the write
+        warehouse (dict): stream into the warehouse instead, see
+            stream_to_warehouse
+    '''
+    remove_staged_files(source_path, 'counter_d')
+    counter_d = generate_counter_dimension(key_registry)
+    create_output_file(counter_d, os.path.join(source_path, 'counter_d'),
+                       output_format, output_manifest, warehouse)
+    logging.info(f"Staged {len(counter_d)} counter_d rows")
+
+def dimension_date_range(fact_summaries, weather_date_ranges):
+    '''
+    Finds the dates date_d has to cover for this run's facts and weather
+    Parameters:
+        fact_summaries (dict): output of build_fact_csvs
+        weather_date_ranges (dict): output of transform_weather_data
+    Returns:
+        (first_date, last_date) (tuple): ISO formatted dates, None if
+            nothing was staged
+    '''
+    dates = [date for low, high in weather_date_ranges.values()
+             for date in (low, high)]
+    for summary in fact_summaries.values():
+        if summary['utc_date_min']:
+            # local dates are at most a day either side of the UTC ones
+            dates += [(pd.Timestamp(summary['utc_date_min'])
+                       - pd.Timedelta(days=1)).date().isoformat(),
+                      (pd.Timestamp(summary['utc_date_max'])
+                       + pd.Timedelta(days=1)).date().isoformat()]
+    if not dates:
+        return None
+    return min(dates), max(dates)
+
+def load_dimension_state(state_path=DIMENSION_STATE_PATH):
+    '''
+    Reads the date range already loaded into date_d
+    Parameters:
+        state_path (str): path to the state .json
+    Returns:
+        dimension_state (dict): {'date_d':{'first_date', 'last_date'}}, empty
+            if nothing has been loaded yet
+    '''
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_dimension_state(dimension_state, state_path=DIMENSION_STATE_PATH):
+    '''
+    Records the date range loaded into date_d. Only call once the load has
+        succeeded
+    Parameters:
+        dimension_state (dict): see load_dimension_state
+        state_path (str): path to the state .json
+    '''
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path, 'w') as f:
+        json.dump(dimension_state, f, indent=2)
+
+def stage_dimensions(source_path, date_range, loaded_range=None,
+                     output_format='csv', output_manifest=None,
+                     warehouse=None):
+    '''
+    Generates and stages date_d and time_d. date_d covers the run's dates
+        or, when a range has already been loaded, only the days needed to
+        extend it, so an incremental load appends them instead of
+        reloading the whole dimension. The range never has gaps
+    Parameters:
+        source_path (str): the staging folder
+        date_range (tuple): output of dimension_date_range
+        loaded_range (dict): {'first_date', 'last_date'} already in date_d,
+            None stages the whole range
+        output_format (str): 'csv' or 'parquet'
+        output_manifest (dict): where to record the writes
+        warehouse (dict): stream into the warehouse instead, see
+            stream_to_warehouse
+    Returns:
+        dimension_range (dict): {'first_date', 'last_date'} date_d covers
+            once these files are loaded, None if there are no dates at all
+    '''
+    remove_staged_files(source_path, 'date_d')
+    remove_staged_files(source_path, 'time_d')
+    first_date, last_date = date_range or (None, None)
+    if loaded_range:
+        first_date = min(filter(None, [first_date,
+                                       loaded_range['first_date']]))
+        last_date = max(filter(None, [last_date, loaded_range['last_date']]))
+        day = pd.Timedelta(days=1)
+        dates = pd.date_range(first_date,
+                              pd.Timestamp(loaded_range['first_date']) - day)\
+            .append(pd.date_range(pd.Timestamp(loaded_range['last_date'])
+                                  + day, last_date))
+    elif first_date:
+        dates = pd.date_range(first_date, last_date)
+    else:
+        dates = pd.DatetimeIndex([])
+    date_d = generate_date_dimension(dates)
+    # written even when empty, so the COPY still finds a file to load
+    create_output_file(date_d, os.path.join(source_path, 'date_d'),
+                       output_format, output_manifest, warehouse)
+    create_output_file(generate_time_dimension(),
+                       os.path.join(source_path, 'time_d'), output_format,
+                       output_manifest, warehouse)
+    logging.info(f"Staged {len(date_d)} date_d rows, date_d covers \
+{first_date} to {last_date}")
+    if first_date is None:
+        return None
+    return {'first_date': first_date, 'last_date': last_date}
+
+def read_staged_file(file_path, columns=None, dtype=None):
+    '''
+    Reads a staged .csv or .parquet file back into a dataframe
+    Parameters:
+        file_path (str)
+        columns (list): only read these columns
+        dtype (dict): .csv columns to read as, by column name. Parquet
+            files are already typed
+    Returns:
+        dataframe (Pandas dataframe)
+    '''
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path, columns=columns)
+    return pd.read_csv(file_path, usecols=columns, dtype=dtype)
+
+def join_nearest_weather(facts, weather, tolerance_hours=1):
+    '''
+    Joins each fact to its station's weather for the same UTC hour or, when
+        that hour wasn't observed, the nearest one within the tolerance.
+        weather_id is the station's key * WEATHER_KEY_STRIDE + the UTC hour,
+        so a single as-of join on it covers every station without ever
+        matching one station's facts to another's weather
+    Parameters:
+        facts (Pandas dataframe): staged bicycle_fact rows
+        weather (Pandas dataframe): weather_id and the weather_measures
+            of staged weather_d rows
+        tolerance_hours (int): how far the matched hour can be, 0 only
+            matches the exact hour
+    Returns:
+        enriched (Pandas dataframe): bicycle_weather_fact rows, in the same
+            order as the facts. Facts without weather in range have blank
+            weather columns
+    '''
+    weather = weather.rename(columns={'weather_id': 'observed_weather_id'})
+    weather['observed_weather_id'] = weather['observed_weather_id']\
+        .astype('int64')
+    facts = facts.assign(weather_id=facts['weather_id'].astype('int64'))
+    # as-of joins need both sides sorted, the facts' index keeps their order
+    enriched = pd.merge_asof(
+        facts.sort_values('weather_id', kind='mergesort')\
+            .reset_index(),
+        weather.sort_values('observed_weather_id'),
+        left_on='weather_id', right_on='observed_weather_id',
+        direction='nearest', tolerance=tolerance_hours)\
+        .set_index('index').sort_index()
+    enriched['weather_offset_hours'] = (enriched['observed_weather_id']
+                                        - enriched['weather_id'])\
+        .astype('Int32')
+    enriched['weather_id'] = enriched['observed_weather_id'].astype('Int64')
+    return enriched[enriched_columns['bicycle_weather_fact']]\
+        .reset_index(drop=True)
+
+def rollup_enriched_facts(enriched, period='day'):
+    '''
+    Rolls the enriched facts up per counter and local day or week. Weeks
+        start on Sunday, like date_d's week_of_year
+    Parameters:
+        enriched (Pandas dataframe): output of join_nearest_weather
+        period (str): 'day' or 'week'
+    Returns:
+        rollup (Pandas dataframe): bicycle_daily_agg or bicycle_weekly_agg
+            rows
+    '''
+    dates = pd.to_datetime(enriched['date_id'].astype(str), format='%Y%m%d')
+    if period == 'week':
+        key = 'week_start_id'
+        dates = dates - pd.to_timedelta((dates.dt.dayofweek + 1) % 7,
+                                        unit='D')
+    elif period == 'day':
+        key = 'date_id'
+    else:
+        raise ValueError(f"Unknown rollup period '{period}'")
+    enriched = enriched.assign(**{key: date_keys(dates)},
+                               rainy_hours=enriched['hourly_precipitation_mm']
+                               > RAINY_HOUR_MM)
+    grouped = enriched.groupby(['counter_id', key])
+    # blank rather than 0 when nothing was counted or observed
+    sums = grouped[['bicycle_count', 'hourly_precipitation_mm', 'snow_mm']]\
+        .sum(min_count=1)
+    rollup = pd.DataFrame({
+        'bicycle_count': sums['bicycle_count'],
+        'counted_hours': grouped['bicycle_count'].count(),
+        'weather_hours': grouped['weather_id'].count(),
+        'min_temperature_c': grouped['temperature_c'].min(),
+        'avg_temperature_c': grouped['temperature_c'].mean().round(2),
+        'max_temperature_c': grouped['temperature_c'].max(),
+        'precipitation_mm': sums['hourly_precipitation_mm'],
+        'snow_mm': sums['snow_mm'],
+        'rainy_hours': grouped['rainy_hours'].sum().astype('int64')})
+    return rollup.reset_index()[enriched_columns[
+        'bicycle_daily_agg' if period == 'day' else 'bicycle_weekly_agg']]
+
+def stage_enriched_tables(source_path, tolerance_hours=1, output_format='csv',
+                          output_manifest=None, fact_files=None,
+                          weather_files=None):
+    '''
+    Stages bicycle_weather_fact, the facts joined to their nearest weather,
+        along with its daily and weekly rollups. They're built from the
+        staged bicycle_fact and weather_d files, one counter's fact file at
+        a time, so dashboards can scan them instead of joining on every
+        query
+    Parameters:
+        source_path (str): the staging folder
+        tolerance_hours (int): see join_nearest_weather
+        output_format (str): 'csv' or 'parquet'
+        output_manifest (dict): where to record the writes
+        fact_files (list): the bicycle_fact files to enrich, e.g. this
+            run's output manifest keys. None uses every staged one
+        weather_files (list): the weather_d files to join, None uses every
+            staged one
+    '''
+    file_extension = f'.{output_format}'
+    for table_name in enriched_columns:
+        remove_staged_files(source_path, table_name)
+    weather_columns = ['weather_id'] + weather_measures
+    if fact_files is None:
+        fact_files = staged_table_files(source_path, 'bicycle_fact',
+                                        file_extension)
+    if weather_files is None:
+        weather_files = staged_table_files(source_path, 'weather_d',
+                                           file_extension)
+    # the condition code stays text, like in weather_d
+    weather_dtypes = {'weather_condition_code': 'string'}
+    weather = pd.concat([read_staged_file(os.path.join(source_path, file),
+                                          weather_columns, weather_dtypes)
+                         for file in weather_files], ignore_index=True)\
+        if weather_files else pd.DataFrame(
+            {column: pd.Series(dtype=weather_dtypes.get(column, 'float64'))
+             for column in weather_columns})
+    for file in sorted(fact_files):
+        # bicycle_fact-{i} holds a single counter, so its rollups are whole
+        i = re.split('-|\.', file)[1]
+        enriched = join_nearest_weather(
+            read_staged_file(os.path.join(source_path, file)), weather,
+            tolerance_hours)
+        for table_name, dataframe in [
+                ('bicycle_weather_fact', enriched),
+                ('bicycle_daily_agg', rollup_enriched_facts(enriched, 'day')),
+                ('bicycle_weekly_agg', rollup_enriched_facts(enriched,
+                                                             'week'))]:
+            create_output_file(dataframe,
+                               os.path.join(source_path, f'{table_name}-{i}'),
+                               output_format, output_manifest)
+        logging.info(f"Enriched {file}, {enriched['weather_id'].count()} of \
+{len(enriched)} facts have weather")
+
+def staged_table_files(source_path, table_name, file_extension):
+    '''
+    Lists the staged files that belong to a table
+    Parameters:
+        source_path (str): the staging folder
+        table_name (str): the file prefix, e.g. 'bicycle_fact'
+        file_extension (str): '.csv' or '.parquet'
+    Returns:
+        files (list): sorted file names
+    '''
+    return sorted(file for file in os.listdir(source_path)
+                  if re.split('-|\.', file)[0] == table_name
+                  and file.endswith(file_extension))
+
+def part_boundaries(total_rows, parts):
+    '''
+    Splits a row count into roughly equal, contiguous ranges
+    Parameters:
+        total_rows (int)
+        parts (int)
+    Returns:
+        boundaries (list): [(first_row, end_row),...], end_row exclusive
+    '''
+    return [(k * total_rows // parts, (k + 1) * total_rows // parts)
+            for k in range(parts)]
+
+def split_csv_files(source_files, part_files, total_rows):
+    '''
+    Re-partitions a set of .csv's that share a header into the given part
+        files, each holding a roughly equal share of the rows
+    Parameters:
+        source_files (list): paths to read, in order
+        part_files (list): paths to write
+        total_rows (int): data rows across all the source files
+    '''
+    boundaries = part_boundaries(total_rows, len(part_files))
+    row = 0
+    part = 0
+    out = None
+    try:
+        for source_file in source_files:
+            with open(source_file, 'rb') as f:
+                header = f.readline()
+                for line in f:
+                    while row >= boundaries[part][1]:
+                        part += 1
+                        out.close()
+                        out = None
+                    if out is None:
+                        out = open(part_files[part], 'wb')
+                        out.write(header)
+                    out.write(line)
+                    row += 1
+    finally:
+        if out is not None:
+            out.close()
+
+def unified_parquet_schema(source_files):
+    '''
+    Builds one schema that every file in a multi-part parquet output can be
+        cast to. A column that's int64 in one file and double in another
+        (a counter with blanks) becomes double, anything else that disagrees
+        becomes a string
+    Parameters:
+        source_files (list): paths to .parquet files
+    Returns:
+        schema (pyarrow.Schema)
+    '''
+    schemas = [pq.read_schema(file) for file in source_files]
+    fields = []
+    for field in schemas[0]:
+        types = {schema.field(field.name).type for schema in schemas}
+        types.discard(pa.null())
+        if len(types) == 1:
+            fields.append(pa.field(field.name, types.pop()))
+        elif types and all(pa.types.is_integer(t) or pa.types.is_floating(t)
+                           for t in types):
+            fields.append(pa.field(field.name, pa.float64()))
+        elif types:
+            fields.append(pa.field(field.name, pa.string()))
+        else:
+            fields.append(pa.field(field.name, pa.null()))
+    return pa.schema(fields)
+
+def split_parquet_files(source_files, part_files, total_rows):
+    '''
+    Re-partitions a set of .parquet files into the given part files, each
+        holding a roughly equal share of the rows. Reads a batch at a time
+    Parameters:
+        source_files (list): paths to read, in order
+        part_files (list): paths to write
+        total_rows (int): rows across all the source files
+    '''
+    schema = unified_parquet_schema(source_files)
+    boundaries = part_boundaries(total_rows, len(part_files))
+    row = 0
+    part = 0
+    writer = None
+    try:
+        for source_file in source_files:
+            for batch in pq.ParquetFile(source_file).iter_batches(
+                    batch_size=65536):
+                batch = pa.Table.from_batches([batch]).cast(schema)
+                while batch.num_rows:
+                    while row >= boundaries[part][1]:
+                        part += 1
+                        writer.close()
+                        writer = None
+                    if writer is None:
+                        writer = pq.ParquetWriter(part_files[part], schema,
+                                                  compression='snappy')
+                    take = min(batch.num_rows, boundaries[part][1] - row)
+                    writer.write_table(batch.slice(0, take))
+                    batch = batch.slice(take)
+                    row += take
+    finally:
+        if writer is not None:
+            writer.close()
+
+def create_copy_manifest(split_path, table_name, part_files, s3_bucket,
+                         key_prefix, compress=False):
+    '''
+    Writes a Redshift COPY manifest listing exactly the part files of a
+        table, as manifests/{table_name}.manifest in the split folder
+    Parameters:
+        split_path (str): folder holding the part files
+        table_name (str)
+        part_files (list): part file names
+        s3_bucket (str): short S3 bucket name
+        key_prefix (str): the prefix the parts are uploaded under
+        compress (bool): the parts are uploaded gzipped, with .gz added
+    Returns:
+        manifest_file (str): path to the manifest
+    '''
+    entries = []
+    for part_file in part_files:
+        entry = {'url': f"s3://{s3_bucket}/{key_prefix}{part_file}\
+{'.gz' if compress else ''}",
+                 'mandatory': True}
+        if part_file.endswith('.parquet'):
+            # required for columnar formats
+            entry['meta'] = {'content_length':
+                             os.path.getsize(os.path.join(split_path,
+                                                          part_file))}
+        entries.append(entry)
+    manifest_folder = os.path.join(split_path, 'manifests')
+    os.makedirs(manifest_folder, exist_ok=True)
+    manifest_file = os.path.join(manifest_folder, f'{table_name}.manifest')
+    with open(manifest_file, 'w') as f:
+        json.dump({'entries': entries}, f, indent=2)
+    return manifest_file
+
+def split_staged_output(source_path, split_path, s3_bucket, key_prefix,
+                        parts, output_format='csv', compress=False,
+                        table_names=('bicycle_fact', 'weather_d', 'date_d',
+                                     'time_d'), output_manifest=None):
+    '''
+    Re-partitions each table's staged output into a fixed number of roughly
+        equal parts and writes a COPY manifest for each table, so a load
+        uses every slice evenly and only ever reads these objects. Parts
+        are named {table_name}.part-{k}.{output_format}
+    Parameters:
+        source_path (str): the staging folder
+        split_path (str): where to write the parts and manifests, emptied
+            first
+        s3_bucket (str): short S3 bucket name
+        key_prefix (str): the prefix the parts will be uploaded under
+        parts (int): parts per table, ideally a multiple of the cluster's
+            slice count. Tables with fewer rows get one part per row
+        output_format (str): 'csv' or 'parquet'
+        compress (bool): the parts will be uploaded gzipped
+        table_names (tuple): the tables to split
+        output_manifest (dict): the staged files' row counts, see
+            record_output. Without it every file is counted again. Tables
+            without rows get no parts and no manifest, since Redshift
+            rejects an empty one
+    Returns:
+        table_parts (dict): {'table_name':[part file names],...}
+    '''
+    if os.path.isdir(split_path):
+        shutil.rmtree(split_path)
+    os.makedirs(split_path)
+    file_extension = f'.{output_format}'
+    table_parts = {}
+    for table_name in table_names:
+        source_files = [os.path.join(source_path, file) for file in
+                        staged_table_files(source_path, table_name,
+                                           file_extension)]
+        if output_manifest is not None:
+            total_rows = sum(output_manifest[os.path.basename(file)]['rows']
+                             for file in source_files)
+        else:
+            total_rows = sum(fast_row_count(file) for file in source_files)
+        if not total_rows:
+            logging.info(f"No {table_name} rows staged, nothing to split")
+            table_parts[table_name] = []
+            continue
+        table_part_count = max(1, min(parts, total_rows))
+        part_files = [f'{table_name}.part-{k:04d}{file_extension}'
+                      for k in range(table_part_count)]
+        part_paths = [os.path.join(split_path, file) for file in part_files]
+        if output_format == 'parquet':
+            split_parquet_files(source_files, part_paths, total_rows)
+        else:
+            split_csv_files(source_files, part_paths, total_rows)
+        # parts past the last row are never opened
+        part_files = [file for file, path in zip(part_files, part_paths)
+                      if os.path.exists(path)]
+        create_copy_manifest(split_path, table_name, part_files, s3_bucket,
+                             key_prefix, compress)
+        logging.info(f"Split {len(source_files)} {table_name} files \
+({total_rows} rows) into {len(part_files)} parts")
+        table_parts[table_name] = part_files
+    return table_parts
+
+def upload_file_to_s3(s3_client, source_file, s3_bucket, key,
+                      transfer_config=None, compress=False, upload_stats=None):
+    '''
+    Uploads a single file unless the object already in the bucket was made
+        from identical contents. The SHA-256 of the local file is stored as
+        object metadata and compared on the next upload
+    Parameters:
+        s3_client (boto3 S3 client)
+        source_file (str): path to the file to upload
+        s3_bucket (str): short S3 bucket name
+        key (str): the object key
+        transfer_config (boto3.s3.transfer.TransferConfig): multipart and
+            concurrency settings
+        compress (bool): gzip the file before uploading it
+        upload_stats (dict): when given, {'key':{'seconds', 'bytes_in',
+            'bytes_out', 'uploaded'},...} is filled in for the run report
+    Returns:
+        uploaded (bool): False if the upload was skipped
+    '''
+    started = time.perf_counter()
+    stats = {'bytes_in': os.path.getsize(source_file), 'bytes_out': 0,
+             'uploaded': False}
+    if upload_stats is not None:
+        upload_stats[key] = stats
+    source_sha256 = file_fingerprint(source_file)['sha256']
+    try:
+        head = s3_client.head_object(Bucket=s3_bucket, Key=key)
+        if head.get('Metadata', {}).get('source-sha256') == source_sha256:
+            logging.info(f"'{key}' is unchanged in bucket '{s3_bucket}', \
+skipping upload")
+            stats['seconds'] = round(time.perf_counter() - started, 3)
+            return False
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey',
+                                               'NotFound'):
+            raise
+
+    upload_path = source_file
+    if compress:
+        # mtime=0 keeps the compressed bytes the same for the same input
+        with tempfile.NamedTemporaryFile(suffix='.gz', delete=False) as temp:
+            with open(source_file, 'rb') as f_in, gzip.GzipFile(
+                    fileobj=temp, mode='wb', mtime=0) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        upload_path = temp.name
+    try:
+        logging.info(f"Uploading '{key}' to bucket '{s3_bucket}'")
+        s3_client.upload_file(upload_path, s3_bucket, key,
+                              ExtraArgs={'Metadata':
+                                         {'source-sha256': source_sha256}},
+                              Config=transfer_config)
+        stats['bytes_out'] = os.path.getsize(upload_path)
+        stats['uploaded'] = True
+    finally:
+        if compress:
+            os.remove(upload_path)
+        stats['seconds'] = round(time.perf_counter() - started, 3)
+    return True
+
+def copy_to_s3(source_path, s3_bucket, key_prefix='', file_extension=None,
+               compress=False, max_workers=4, multipart_threshold_mb=64,
+               multipart_chunksize_mb=16, max_concurrency=10,
+               endpoint_url=None, s3_client=None, upload_stats=None,
+               table_name=None):
     '''
     Copies files from a local path to an S3 bucket. You'll need to
-    use the AWS CLI to set your ID, secret, and region
+    use the AWS CLI to set your ID, secret, and region. Files are uploaded
+    in parallel, and files whose contents match the object already in the
+    bucket are skipped
     Parameters:
         source_path (str): path to a set of files to upload
         s3_bucket (str): short S3 bucket name
+        key_prefix (str): prepended to each file name to build its key
+        file_extension (str): only upload files ending with this, e.g.
+            '.parquet'. None uploads everything
+        compress (bool): gzip each file and add .gz to its key
+        max_workers (int): files uploaded at once
+        multipart_threshold_mb (int): files larger than this are uploaded
+            in parts
+        multipart_chunksize_mb (int): size of each part
+        max_concurrency (int): parts uploaded at once per file
+        endpoint_url (str): S3 compatible endpoint, e.g. a local stand-in
+        s3_client: an already created client (or anything with the same
+            head_object/upload_file methods) to use instead of boto3's
+        upload_stats (dict): per-file timings and bytes are added to it,
+            see upload_file_to_s3
+        table_name (str): only upload the files staged for this table, e.g.
+            'weather_d'. None uploads every table's files. Objects under the
+            table's prefix that this upload didn't produce, like the parts
+            of a run that staged more, are deleted so COPY never loads them
     Returns:
-        source_counts (dict): {'file_name':row_count,...}
+        upload_results (dict): {'key':True if uploaded,...}
     '''
-    s3 = boto3.resource('s3')
-    i = 0
-    for root, dir, files in os.walk(source_path):
-        logging.info(f"Found {files.count} files, preparing to upload")
+    if s3_client is None:
+        s3_client = boto3.client('s3', endpoint_url=endpoint_url)
+    transfer_config = TransferConfig(
+        multipart_threshold=multipart_threshold_mb * 1024 * 1024,
+        multipart_chunksize=multipart_chunksize_mb * 1024 * 1024,
+        max_concurrency=max_concurrency)
+    files = sorted(file for file in os.listdir(source_path)
+                   if os.path.isfile(os.path.join(source_path, file))
+                   and (not file_extension or file.endswith(file_extension))
+                   and (not table_name
+                        or re.split('-|\.', file)[0] == table_name))
+    logging.info(f"Found {len(files)} files, preparing to upload")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)\
+            as executor:
+        futures = {}
         for file in files:
-            logging.info(f"Uploading '{file}' to bucket '{s3_bucket}'")
-            s3.meta.client.upload_file(
-                os.path.join(source_path, file),
-                s3_bucket,
-                file
-            )
-            logging.info("Upload complete")
-            i += 1
-    logging.info(f"Finished uploading {i} files")
-
-def create_tables(cur, con):
+            key = key_prefix + file + ('.gz' if compress else '')
+            futures[key] = executor.submit(upload_file_to_s3, s3_client,
+                                           os.path.join(source_path, file),
+                                           s3_bucket, key, transfer_config,
+                                           compress, upload_stats)
+        upload_results = {key: future.result()
+                          for key, future in futures.items()}
+    logging.info(f"Finished uploading {sum(upload_results.values())} files, \
+{len(upload_results) - sum(upload_results.values())} were unchanged")
+    if table_name:
+        remove_stale_objects(s3_client, s3_bucket, key_prefix + table_name,
+                             upload_results)
+    return upload_results
+
+def remove_stale_objects(s3_client, s3_bucket, prefix, keep_keys):
+    '''
+    Deletes the objects under a key prefix that aren't in keep_keys
+    Parameters:
+        s3_client: boto3 S3 client
+        s3_bucket (str): short S3 bucket name
+        prefix (str): e.g. 'parquet/weather_d'
+        keep_keys (iterable): the keys to leave in place
+    Returns:
+        stale_keys (list): the keys deleted
+    '''
+    keep_keys = set(keep_keys)
+    stale_keys = [item['Key']
+                  for page in s3_client.get_paginator('list_objects_v2')\
+                      .paginate(Bucket=s3_bucket, Prefix=prefix)
+                  for item in page.get('Contents', [])
+                  if item['Key'] not in keep_keys]
+    # delete_objects takes at most 1000 keys
+    for start in range(0, len(stale_keys), 1000):
+        s3_client.delete_objects(Bucket=s3_bucket, Delete={
+            'Objects': [{'Key': key}
+                        for key in stale_keys[start:start + 1000]]})
+    if stale_keys:
+        logging.info(f"Deleted {len(stale_keys)} stale objects under \
+{prefix}")
+    return stale_keys
+
+def create_tables(cur, con, query_list=create_table_queries, commit=True):
     '''
     Drops/recreates fact and dim tables on the target database
     Parameters:
         cur (psycopg2 cursor object)
         con (psycopg2 connection object)
+        query_list (list): the DDL to run, defaults to dropping and
+            recreating every table
+        commit (bool): commit each statement, logging and skipping the
+            ones that fail. When False the DDL is left in the open
+            transaction for whatever commits it, and the first failure is
+            raised
     '''
-    for query in create_table_queries:
+    for query in query_list:
         logging.info(f"Executing query {query[:64]}...")
         try:
             cur.execute(query)
-            con.commit()
+            if commit:
+                con.commit()
         except Exception as e:
-            logging(e)
+            logging.error(e)
+            con.rollback()
+            if not commit:
+                raise
     logging.info("Done with creating tables")
 
-def load_redshift_tables(cur, con):
+def outdated_tables(cur, query_list):
+    '''
+    Finds the tables a set of DDL keeps in place whose live columns don't
+        match the DDL, like a bicycle_fact or weather_d from before the
+        surrogate keys
+    Parameters:
+        cur (psycopg2 cursor)
+        query_list (list): the DDL a run is about to execute
+    Returns:
+        outdated (list): the table names
+    '''
+    kept = kept_tables(query_list)
+    if not kept:
+        return []
+    cur.execute(live_table_columns, (tuple(sorted(kept)),))
+    return outdated_live_tables(cur.fetchall(), query_list)
+
+def load_redshift_tables(cur, con, query_list):
     '''
     Performs a copy of data from the source S3 bucket to
         a set of staging tables using the cursor and connection
@@ -243,33 +2097,112 @@ def load_redshift_tables(cur, con):
     Parameters:
         cur (psycopg2 cursor)
         con (psycopg2 connection)
+        query_list (list): the COPY statements to run
     '''
     logging.info("Loading redshift tables")
-    for query in copy_table_queries:
+    for query in query_list:
         logging.info(f"{query[:24]}...")
         cur.execute(query)
         con.commit()
     logging.info("finished loading redshift tables")
     
-def target_control_totals(cur, query_list):
+def merge_redshift_tables(cur, con, query_list):
+    '''
+    Runs the staging-table COPY and upsert statements from
+        sql_queries.merge_load_queries as a single transaction, so the live
+        tables switch from the old rows to the new ones all at once and
+        are left untouched if anything fails
+    Parameters:
+        cur (psycopg2 cursor)
+        con (psycopg2 connection)
+        query_list (list): output of merge_load_queries
+    '''
+    logging.info("Merging staged data into redshift tables")
+    try:
+        for query in query_list:
+            logging.info(f"{query.strip()[:48]}...")
+            cur.execute(query)
+        con.commit()
+    except Exception:
+        con.rollback()
+        logging.error("Merge failed, rolled back")
+        raise
+    logging.info("finished merging redshift tables")
+
+def maintain_redshift_tables(cur, con, analyze_tables, vacuum_tables=()):
+    '''
+    Re-sorts tables that rows were appended or upserted into and refreshes
+        the planner's statistics after a load. Runs in autocommit, as
+        Redshift won't VACUUM inside a transaction
+    Parameters:
+        cur (psycopg2 cursor)
+        con (psycopg2 connection)
+        analyze_tables (list): tables to ANALYZE
+        vacuum_tables (list): tables to VACUUM first
+    '''
+    autocommit = con.autocommit
+    con.autocommit = True
+    try:
+        for table_name in vacuum_tables:
+            logging.info(f"Vacuuming {table_name}")
+            cur.execute(vacuum_table.format(table_name=table_name))
+        for table_name in analyze_tables:
+            logging.info(f"Analyzing {table_name}")
+            cur.execute(analyze_table.format(table_name=table_name))
+    finally:
+        con.autocommit = autocommit
+    logging.info("finished maintaining redshift tables")
+
+def run_validation_suite(cur, checks=validation_suite, source_counts=None):
     '''
-    Performs basic row counts on the target tables for comparison with
-        similar counts on the source files
+    Runs a declarative set of checks against the target tables with one
+        query per table (see sql_queries.compile_validation_suite) and
+        evaluates every check against the results
     Parameters:
         cur (psycopg2 cursor)
-        query_list (a list of queries)
+        checks (list): {'table', 'kind', 'columns'} dictionaries
+        source_counts (dict): {'table_name':row_count,...}, row_count checks
+            compare against these when given
     Returns:
-        target_counts (dict): {'table_name':row_count,...}
+        report (dict): 'tables' holds the raw metrics per table, 'checks'
+            holds each check with its observed and expected values and
+            whether it passed, 'passed' is True if every check passed
     '''
-    target_counts = {}
-    for query in query_list:
-        # split and drop \n
-        table_name = query.split('FROM ',1)[-1][:-1]
-        logging.info(f"Counting rows on {table_name}")
+    tables = {}
+    for table_name, (query, aliases) in compile_validation_suite(checks)\
+            .items():
+        logging.info(f"Validating {table_name}")
         cur.execute(query)
-        count = cur.fetchone()[0]
-        target_counts[table_name]=count
-    return target_counts
+        tables[table_name] = dict(zip(aliases, cur.fetchone()))
+
+    results = []
+    for check in checks:
+        metrics = tables[check['table']]
+        columns = check.get('columns', [])
+        if check['kind'] == 'row_count':
+            observed = metrics['row_count']
+            expected = (source_counts or {}).get(check['table'])
+            passed = expected is None or observed == expected
+        elif check['kind'] == 'unique':
+            observed = metrics[distinct_key_alias(columns)]
+            expected = metrics['row_count']
+            passed = observed == expected
+        else:
+            observed = sum(metrics[f'null_{column}'] for column in columns)
+            expected = 0
+            passed = observed == expected
+        results.append({'table': check['table'],
+                        'kind': check['kind'],
+                        'columns': columns,
+                        'observed': observed,
+                        'expected': expected,
+                        'passed': passed})
+        logging.info(f"{check['kind']} check on {check['table']} {columns}: \
+{'passed' if passed else 'FAILED'} (observed {observed}, expected {expected})")
+
+    return {'tables': tables,
+            'checks': results,
+            'passed': all(result['passed'] for result in results)}
 
 def fast_row_count(file):
     '''
@@ -278,16 +2211,21 @@ def fast_row_count(file):
         file (str): a file path
     Returns: integer
     '''
+    if str(file).endswith('.parquet'):
+        # parquet keeps its row count in the footer
+        return pq.ParquetFile(file).metadata.num_rows
     with open(file) as f:
         return sum(1 for line in f) - 1
 
-def source_control_totals(source_path):
+def source_control_totals(source_path, file_extension=None):
     '''
     Performs basic row counts on the source files for comparison with
         similar counts on the target files
     Parameters:
         source_path (path-like): the directory that contains the files you
         wish to retrieve control totals for
+        file_extension (str): only count files ending with this, e.g.
+            '.parquet'. None counts everything
     Returns:
         source_counts (dict): {'short_file_name':row_count,...}
     '''
@@ -296,7 +2234,10 @@ def source_control_totals(source_path):
     source_counts = {}
     for root, dir, files in os.walk(source_path):
         logging.info(f"Preparing source control totals on files found in {source_path}")
-        for file in files:
+        # sorted so the parts of a multi-part source are next to each other
+        for file in sorted(files):
+            if file_extension and not file.endswith(file_extension):
+                continue
             # accounts for multi-part sources
             file_short = re.split('-|\.',str(file))[0]
             count = fast_row_count(os.path.join(source_path, file))
@@ -310,112 +2251,738 @@ def source_control_totals(source_path):
     logging.info("Source control totals complete")
     return source_counts
 
-def check_dim_uniqueness(cur, total_dim_queries, unique_dim_queries):
+def create_run_report():
+    '''
+    Starts an empty run report for instrument_stage to fill in
+    Returns:
+        run_report (dict): 'run_id', 'started_at', 'status' and 'stages'
     '''
-    Compares target control totals to unique counts on the dimension tables
-        as defined by what makes a unique record in the corresponding query
-        in sql_queries.py and indicates if the two counts are equal
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    return {'run_id': started_at.strftime('%Y%m%dT%H%M%S'),
+            'started_at': started_at.isoformat(),
+            'status': 'running',
+            'stages': []}
+
+def reset_peak_rss():
+    '''
+    Resets the process' peak resident set size so the next reading only
+        covers the stage about to run. Only Linux supports this, elsewhere
+        the reading stays the peak since the process started
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_bytes(children=False):
+    '''
+    Reads the peak resident set size of this process, or of the largest
+        worker process it has waited on
     Parameters:
-        cur (psycopg2 cursor)
-        total_dim_queries (list): a list of queries that will return counts
-        unique_dim_queries (list): a list of queries that will, based on the
-            columns specified in each query on sql_queries.py, return a
-            count of their unique values
-    Returns: True or False
-    '''
-    unique_counts = {}
-    target_counts = target_control_totals(cur, total_dim_queries)
-    for query in unique_dim_queries:
-        # split and drop \n
-        table_name = query.split('FROM ')[-1][:-1]
-        logging.info(f"Counting unique values on {table_name}")
-        cur.execute(query)
-        count = cur.fetchone()[0]
-        unique_counts[table_name]=count
-    logging.info(f"Total dim counts: {target_counts}")
-    logging.info(f"Unique dim counts: {unique_counts}")
-    if unique_counts == target_counts:
-        logging.info("Dim uniqueness check passed")
-        return True
-    else:
-        logging.info("Dim uniqueness check failed")
-        return False
+        children (bool): read the worker processes' peak instead
+    Returns:
+        peak (int): bytes, None where it can't be measured (Windows)
+    '''
+    if not children:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes everywhere except macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
 
-def no_fk_blanks_on_bicycle_fact(cur):
+@contextlib.contextmanager
+def instrument_stage(run_report, stage_name, reset_peak=True):
     '''
-    Checks the columns used as FK's on the bicycle_fact table for nulls
-        and returns the count of any nulls found
+    Times a pipeline stage and records it in the run report. The caller
+        fills in the volumes on the yielded dict, e.g.
+            with instrument_stage(run_report, 'upload') as stage:
+                stage['rows'] = ...
     Parameters:
-        cur (psycopg2 cursor)
+        run_report (dict): output of create_run_report
+        stage_name (str)
+        reset_peak (bool): reset the peak RSS when the stage starts, so it
+            only covers this stage. Only safe when no other stage is
+            running, otherwise the peak is the process' since it started
+    Yields:
+        stage (dict): 'rows', 'bytes_in', 'bytes_out' start at 0, a 'files'
+            list can be added for a per-file breakdown
+    '''
+    stage = {'stage': stage_name, 'status': 'ok',
+             'rows': 0, 'bytes_in': 0, 'bytes_out': 0}
+    if reset_peak:
+        reset_peak_rss()
+    started = time.perf_counter()
+    try:
+        yield stage
+    except Exception:
+        stage['status'] = 'failed'
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        stage['seconds'] = round(seconds, 3)
+        stage['rows_per_sec'] = round(stage['rows'] / seconds, 1)\
+            if seconds else None
+        stage['peak_rss_bytes'] = peak_rss_bytes()
+        stage['peak_child_rss_bytes'] = peak_rss_bytes(children=True)
+        run_report['stages'].append(stage)
+        logging.info(f"Stage {stage_name} {stage['status']} in \
+{stage['seconds']}s, rows: {stage['rows']}, bytes in/out: \
+{stage['bytes_in']}/{stage['bytes_out']}")
+
+def write_prometheus_textfile(run_report, textfile_path):
+    '''
+    Writes the run report's stage metrics in the Prometheus text format,
+        for node_exporter's textfile collector. The file is replaced in one
+        step so a scrape never sees half of it
+    Parameters:
+        run_report (dict): output of create_run_report
+        textfile_path (str): usually ends in .prom
+    '''
+    metrics = [('seconds', 'seconds', 'Wall time of the stage'),
+               ('rows', 'rows', 'Rows handled by the stage'),
+               ('bytes_in', 'bytes_in', 'Bytes read by the stage'),
+               ('bytes_out', 'bytes_out', 'Bytes written by the stage'),
+               ('rows_per_sec', 'rows_per_second', 'Rows per second'),
+               ('peak_rss_bytes', 'peak_rss_bytes',
+                'Peak resident memory during the stage'),
+               ('quality_failed_rows', 'quality_failed_rows',
+                'Rows that failed the quality gate')]
+    lines = []
+    for key, metric, help_text in metrics:
+        name = f'bicycle_pipeline_stage_{metric}'
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+        for stage in run_report['stages']:
+            if stage.get(key) is not None:
+                lines.append(f'{name}{{stage="{stage["stage"]}"}} \
+{stage[key]}')
+    lines += ['# HELP bicycle_pipeline_last_run_success 1 if the last run \
+passed validation',
+              '# TYPE bicycle_pipeline_last_run_success gauge',
+              f"bicycle_pipeline_last_run_success \
+{int(run_report['status'] == 'succeeded')}",
+              '# HELP bicycle_pipeline_last_run_timestamp_seconds When the \
+last run finished',
+              '# TYPE bicycle_pipeline_last_run_timestamp_seconds gauge',
+              f'bicycle_pipeline_last_run_timestamp_seconds {time.time():.0f}']
+    temp_path = textfile_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, textfile_path)
+
+def save_run_report(run_report, report_path=RUN_REPORT_PATH,
+                    textfile_path=None):
+    '''
+    Finishes the run report and writes it to disk, plus a Prometheus
+        textfile if asked for
+    Parameters:
+        run_report (dict): output of create_run_report
+        report_path (str): path to the report .json
+        textfile_path (str): optional Prometheus textfile path
+    '''
+    finished_at = datetime.datetime.now(datetime.timezone.utc)
+    run_report['finished_at'] = finished_at.isoformat()
+    run_report['seconds'] = round((finished_at - datetime.datetime\
+        .fromisoformat(run_report['started_at'])).total_seconds(), 3)
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump(run_report, f, indent=2)
+    if textfile_path:
+        write_prometheus_textfile(run_report, textfile_path)
+    logging.info(f"Saved run report for {len(run_report['stages'])} stages \
+to {report_path}")
+
+def run_stage(stage, results, run_report, reset_peak=True):
+    '''
+    Runs a single scheduled stage inside instrument_stage
+    Parameters:
+        stage (dict): see run_stages
+        results (dict): return values of the stages finished so far
+        run_report (dict): output of create_run_report
+        reset_peak (bool): see instrument_stage
     Returns:
-        True or False
+        the stage function's return value
     '''
-    logging.info(f"Checking for nulls in key columns on fact table")
-    cur.execute(bicycle_no_blanks)
-    should_be_zero = cur.fetchone()[0]
-    logging.info(f"Total nulls found (expecting 0): {should_be_zero}")
-    if should_be_zero == 0:
-        logging.info("Fact table null check passed")
-        return True
+    with instrument_stage(run_report, stage['name'], reset_peak) as record:
+        return stage['func'](results, record)
+
+def run_stages(stages, run_report, io_workers=4, cpu_workers=2,
+               overlap=True):
+    '''
+    Runs the pipeline's stages as soon as the stages they depend on have
+        finished, so downloads and uploads overlap with the fact and
+        weather builds and a run takes about as long as its critical path.
+        Once a stage fails nothing new is started, the stages already
+        running are waited on, and the first failure is raised. Resetting
+        the peak RSS for one stage would clobber the reading of another
+        running alongside it, so overlapping stages report the process'
+        peak since it started and only serial runs get per-stage peaks
+    Parameters:
+        stages (list): {'name', 'func', 'depends_on', 'pool'} dictionaries.
+            func is called with the results of the finished stages and the
+            stage's instrument_stage dict. 'pool' is 'io' for network/disk
+            bound stages or 'cpu' for the ones that build data
+        run_report (dict): output of create_run_report
+        io_workers (int): io stages running at once
+        cpu_workers (int): cpu stages running at once
+        overlap (bool): False runs one stage at a time in list order,
+            the way the pipeline used to run
+    Returns:
+        results (dict): {'stage name':return value,...}
+    '''
+    names = [stage['name'] for stage in stages]
+    for stage in stages:
+        for dependency in stage.get('depends_on', []):
+            if dependency not in names:
+                raise ValueError(f"Stage {stage['name']} depends on unknown \
+stage {dependency}")
+    if overlap:
+        io_pool = concurrent.futures.ThreadPoolExecutor(io_workers)
+        cpu_pool = concurrent.futures.ThreadPoolExecutor(cpu_workers)
     else:
-        logging.info("Fact table null check failed")
-        return False
+        io_pool = cpu_pool = concurrent.futures.ThreadPoolExecutor(1)
+    pools = {'io': io_pool, 'cpu': cpu_pool}
+    results = {}
+    pending = list(stages)
+    running = {}
+    failure = None
+    try:
+        while pending or running:
+            if failure is None:
+                for stage in [stage for stage in pending
+                              if all(dependency in results for dependency
+                                     in stage.get('depends_on', []))]:
+                    pending.remove(stage)
+                    future = pools[stage.get('pool', 'io')].submit(
+                        run_stage, stage, results, run_report, not overlap)
+                    running[future] = stage
+                    if not overlap:
+                        break
+            if not running:
+                if failure is None:
+                    stuck = [stage['name'] for stage in pending]
+                    raise ValueError(f"Stages {stuck} depend on each other")
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage['name']] = future.result()
+                except Exception as e:
+                    logging.error(f"Stage {stage['name']} failed: {e}")
+                    if failure is None:
+                        failure = e
+    finally:
+        io_pool.shutdown()
+        cpu_pool.shutdown()
+    for stage in pending:
+        run_report['stages'].append({'stage': stage['name'],
+                                     'status': 'skipped'})
+    if failure is not None:
+        raise failure
+    return results
             
 def main():
     config = configparser.ConfigParser()
-    config.read('config\config.cfg')
+    config.read(os.path.join(ROOT_DIR, 'config', 'config.cfg'))
     
     # s3 variables
     capstone_bucket = config['S3']['CAPSTONE_BUCKET']
-    source_path = os.path.join(ROOT_DIR, 'data\\output')
+    s3_endpoint_url = config.get('S3', 'ENDPOINT_URL', fallback='') or None
+    upload_gzip = config.getboolean('S3', 'UPLOAD_GZIP', fallback=True)
+    upload_workers = config.getint('S3', 'UPLOAD_WORKERS', fallback=4)
+    multipart_threshold_mb = config.getint('S3', 'MULTIPART_THRESHOLD_MB',
+                                           fallback=64)
+    multipart_chunksize_mb = config.getint('S3', 'MULTIPART_CHUNKSIZE_MB',
+                                           fallback=16)
+    max_concurrency = config.getint('S3', 'MAX_CONCURRENCY', fallback=10)
+    split_path = os.path.join(ROOT_DIR, 'data/split')
+    source_path = os.path.join(ROOT_DIR, 'data/output')
     
-    bicycle_metadata = prepare_bicycle_metadata()
+    # pipeline variables
+    workers = config.getint('PIPELINE', 'WORKERS', fallback=1)
+    cache_ttl_days = config.getfloat('PIPELINE', 'LOCATION_CACHE_TTL_DAYS',
+                                     fallback=30)
+    refresh_cache = config.getboolean('PIPELINE', 'REFRESH_LOCATION_CACHE',
+                                      fallback=False)
+    incremental = config.getboolean('PIPELINE', 'INCREMENTAL', fallback=False)
+    weather_chunk_rows = config.getint('PIPELINE', 'WEATHER_CHUNK_ROWS',
+                                       fallback=0) or None
+    weather_date_pushdown = config.getboolean('PIPELINE',
+                                              'WEATHER_DATE_PUSHDOWN',
+                                              fallback=True)
+    output_format = config.get('PIPELINE', 'OUTPUT_FORMAT', fallback='csv')
+    download_workers = config.getint('PIPELINE', 'DOWNLOAD_WORKERS',
+                                     fallback=4)
+    download_retries = config.getint('PIPELINE', 'DOWNLOAD_RETRIES',
+                                     fallback=3)
+    copy_slices = config.getint('PIPELINE', 'COPY_SLICES', fallback=0)
+    copy_parts_per_slice = config.getint('PIPELINE', 'COPY_PARTS_PER_SLICE',
+                                         fallback=1)
+    load_mode = config.get('PIPELINE', 'LOAD_MODE', fallback='replace')
+    load_backend = config.get('PIPELINE', 'LOAD_BACKEND', fallback='s3')
+    if load_backend not in ('s3', 'direct'):
+        raise ValueError(f"Unknown load backend '{load_backend}'")
+    direct = load_backend == 'direct'
+    direct_buffer_rows = config.getint('PIPELINE', 'DIRECT_BUFFER_ROWS',
+                                       fallback=50000)
+    # only upload/count the files that match the run's format
+    file_extension = '.parquet' if output_format == 'parquet' and not direct\
+        else None
+    prometheus_textfile = config.get('PIPELINE', 'PROMETHEUS_TEXTFILE',
+                                     fallback='') or None
+    overlap_stages = config.getboolean('PIPELINE', 'OVERLAP_STAGES',
+                                       fallback=True)
+    stage_io_workers = config.getint('PIPELINE', 'STAGE_IO_WORKERS',
+                                     fallback=4)
+    stage_cpu_workers = config.getint('PIPELINE', 'STAGE_CPU_WORKERS',
+                                      fallback=2)
+    table_layout = config.getboolean('PIPELINE', 'TABLE_LAYOUT',
+                                     fallback=True)
+    analyze_after_load = config.getboolean('PIPELINE', 'ANALYZE_AFTER_LOAD',
+                                           fallback=True)
+    vacuum_after_load = config.getboolean('PIPELINE', 'VACUUM_AFTER_LOAD',
+                                          fallback=True)
+    enriched_tables = config.getboolean('PIPELINE', 'ENRICHED_TABLES',
+                                        fallback=False)
+    weather_tolerance_hours = config.getint('PIPELINE',
+                                            'WEATHER_TOLERANCE_HOURS',
+                                            fallback=1)
+    if enriched_tables and direct:
+        raise ValueError("ENRICHED_TABLES needs LOAD_BACKEND=s3, they're "
+                         "built from the staged files")
+    if enriched_tables and incremental:
+        # the rollups need every fact of a day/week, not just the delta
+        logging.info("Skipping the enriched tables on an incremental run")
+        enriched_tables = False
+    quality_gate = config.get('PIPELINE', 'QUALITY_GATE', fallback='report')
+    if quality_gate not in ('off', 'report', 'fail', 'quarantine'):
+        raise ValueError(f"Unknown quality gate '{quality_gate}'")
+    if quality_gate == 'off':
+        quality_gate = None
+    # columns staged, created, and loaded for every table this run
+    table_columns = dict(staged_columns)
+    if enriched_tables:
+        table_columns.update(enriched_columns)
     
-    # build df's and stage .csv's in data/output folder
-    i=0
-    for item in bicycle_metadata:
-        df = create_fact_dataframe(item)
-        create_output_csv(df, f'bicycle_fact-{i}.csv')
-        i += 1
+    # per-stage timings and volumes, saved even if a stage fails
+    run_report = create_run_report()
     
-    download_weather_data(bicycle_metadata)
-    transform_weather_data()
-    copy_to_s3(source_path, capstone_bucket)
+    # incremental runs get their own S3 prefix so older deltas aren't
+    # picked up again by the prefix-based COPY
+    # parquet is already compressed, only gzip the .csv's
+    compress = upload_gzip and output_format == 'csv'
+    key_prefix = ''
+    if output_format == 'parquet':
+        key_prefix += 'parquet/'
+    if compress:
+        key_prefix += 'gzip/'
+    if copy_slices:
+        key_prefix += 'manifest/'
+    if incremental:
+        key_prefix += f"incremental/{run_report['run_id']}/"
     
-    # S3 to Redshift
-    con = psycopg2.connect("host={} dbname={} user={} password={} port={}"\
-        .format(*config['CLUSTER'].values()))
-    cur = con.cursor()
+    # every staged write is recorded for the control totals, each staging
+    # stage in its own manifest so concurrent stages never share a dict
+    staged = {'fact_build': {}, 'weather_transform': {}, 'dimensions': {},
+              'counter_dimension': {}, 'enriched': {}}
+    download_path = os.path.join(ROOT_DIR, 'data/download')
+    os.makedirs(source_path, exist_ok=True)
+    # boto3 clients are thread safe, creating them isn't
+    s3_client = boto3.client('s3', endpoint_url=s3_endpoint_url)
+    warehouse = {}
+    # the direct backend streams every table into the warehouse instead of
+    # staging files, the connection is added once the tables exist
+    stream_to = warehouse if direct else None
+    ingest = {}
+    key_registry = load_key_registry()
+    # per-check results of the quality gate, keyed by what each table's
+    # rows were built from
+    quality_report = {}
+    if quality_gate == 'quarantine':
+        # only this run's rejects are kept
+        shutil.rmtree(os.path.join(ROOT_DIR, 'data/quarantine'),
+                      ignore_errors=True)
+    # runs that keep date_d in place only stage the days it's missing
+    extend_date_d = incremental or load_mode == 'merge'
+    loaded_date_range = load_dimension_state().get('date_d')\
+        if extend_date_d else None
     
-    create_tables(cur, con)
-    load_redshift_tables(cur, con)
+    def metadata_stage(results, stage):
+        bicycle_metadata = prepare_bicycle_metadata(cache_ttl_days,
+                                                    refresh_cache)
+        # facts are keyed before they're built, so the keys are saved
+        # right away
+        assign_surrogate_keys(bicycle_metadata, key_registry)
+        save_key_registry(key_registry)
+        # .csv's are appended to and weather parts numbered, so the last
+        # run's files are cleared for the manifest to describe whole files
+        remove_staged_files(source_path, 'bicycle_fact')
+        remove_staged_files(source_path, 'weather_d')
+        if incremental:
+            # only stage what changed since the last successful run
+            ingest['manifest'] = load_ingest_manifest()
+            ingest['fingerprints'] = plan_incremental_ingest(
+                bicycle_metadata, ingest['manifest'])
+        else:
+            # every file is loaded in full, recorded so a later incremental
+            # run only picks up what changed after this one
+            ingest['manifest'] = {}
+            ingest['fingerprints'] = {
+                manifest_key(item['file_path']):
+                    file_fingerprint(item['file_path'])
+                for item in bicycle_metadata}
+        stage['rows'] = len(bicycle_metadata)
+        return bicycle_metadata
     
-    # Control totals
-    target_counts = target_control_totals(cur, target_control_queries)
-    source_counts = source_control_totals(source_path)
-        
-    logging.info(f"Comparing control total dicts (remember, order doesn't matter)")
-    logging.info(source_counts)
-    logging.info(target_counts)
+    def fact_build_stage(results, stage):
+        # build df's and stage .csv's in data/output folder
+        fact_counts, fact_summaries = build_fact_csvs(results['metadata'],
+                                                      workers, output_format,
+                                                      staged['fact_build'],
+                                                      stream_to, quality_gate)
+        for summary in fact_summaries.values():
+            quality_report.update(summary.pop('quality', {}))
+        stage['files'] = [{'file_path': file_path,
+                           'rows': summary['rows'],
+                           'bytes_in': summary['bytes_in'],
+                           'seconds': summary['seconds']}
+                          for file_path, summary in fact_summaries.items()]
+        stage['rows'] = sum(fact_counts.values())
+        stage['bytes_in'] = sum(summary['bytes_in'] for summary
+                                in fact_summaries.values())
+        stage['bytes_out'] = sum(entry['bytes'] for entry
+                                 in staged['fact_build'].values())
+        stage['quality_failed_rows'] = sum(
+            entry['failed_rows'] for entry in quality_report.values()
+            if entry['table'] == 'bicycle_fact')
+        return fact_summaries
     
-    # Control totals test
-    if target_counts == source_counts:
-        logging.info("Control totals match!")
-    else:
-        logging.info("Control totals do NOT match!")
+    def download_stage(results, stage):
+        download_results = download_weather_data(
+            results['metadata'], max_workers=download_workers,
+            retries=download_retries)
+        stage['rows'] = len(download_results)
+        stage['bytes_out'] = sum(
+            os.path.getsize(os.path.join(download_path, f'{station}.csv.gz'))
+            for station, downloaded in download_results.items()
+            if downloaded)
+        return download_results
+    
+    def weather_transform_stage(results, stage):
+        # only keep weather for the dates the facts cover, weather_d is
+        # rebuilt in full so incremental runs include already ingested files
+        utc_date_ranges = None
+        if weather_date_pushdown:
+            utc_date_ranges = station_utc_date_ranges(
+                results['metadata'], results['fact_build'],
+                ingest.get('manifest'))
+        weather_date_ranges = transform_weather_data(
+            weather_chunk_rows, utc_date_ranges, output_format,
+            staged['weather_transform'], key_registry['weather_stations'],
+            stream_to, quality_gate, quality_report)
+        stage['rows'] = manifest_control_totals(staged['weather_transform'])\
+            .get('weather_d', 0)
+        stage['bytes_in'] = sum(
+            os.path.getsize(os.path.join(download_path, f'{station}.csv.gz'))
+            for station in results['download']
+            if utc_date_ranges is None or station in utc_date_ranges)
+        stage['bytes_out'] = sum(entry['bytes'] for entry
+                                 in staged['weather_transform'].values())
+        stage['quality_failed_rows'] = sum(
+            entry['failed_rows'] for entry in quality_report.values()
+            if entry['table'] == 'weather_d')
+        return weather_date_ranges
+    
+    def dimensions_stage(results, stage):
+        # date_d covers every date the facts and weather use
+        date_range = dimension_date_range(results['fact_build'],
+                                          results['weather_transform'])
+        date_d_range = stage_dimensions(source_path, date_range,
+                                        loaded_date_range, output_format,
+                                        staged['dimensions'], stream_to)
+        stage['rows'] = sum(manifest_control_totals(
+            staged['dimensions']).values())
+        stage['bytes_out'] = sum(entry['bytes'] for entry
+                                 in staged['dimensions'].values())
+        return date_d_range
+    
+    def counter_dimension_stage(results, stage):
+        stage_counter_dimension(source_path, key_registry, output_format,
+                                staged['counter_dimension'], stream_to)
+        stage['rows'] = len(key_registry['counters'])
+    
+    def enriched_stage(results, stage):
+        # only the files this run wrote, never leftovers of an earlier one
+        stage_enriched_tables(source_path, weather_tolerance_hours,
+                              output_format, staged['enriched'],
+                              [file for file, entry
+                               in staged['fact_build'].items()
+                               if entry['table'] == 'bicycle_fact'],
+                              [file for file, entry
+                               in staged['weather_transform'].items()
+                               if entry['table'] == 'weather_d'])
+        stage['rows'] = sum(manifest_control_totals(
+            staged['enriched']).values())
+        stage['bytes_out'] = sum(entry['bytes'] for entry
+                                 in staged['enriched'].values())
     
-    # Dim uniqueness testing, excludes fact table
-    dim_count_queries = target_control_queries[1:]
-    uniqueness_check = check_dim_uniqueness(cur, dim_count_queries,
-                                            dim_uniqueness_queries)
+    def output_manifest_stage(results, stage):
+        output_manifest = {}
+        for stage_manifest in staged.values():
+            output_manifest.update(stage_manifest)
+        save_output_manifest(output_manifest)
+        source_counts = manifest_control_totals(output_manifest,
+                                                file_extension)
+        stage['rows'] = sum(source_counts.values())
+        return source_counts
     
-    null_fact_check = no_fk_blanks_on_bicycle_fact(cur)
-    con.close()
+    def upload_stage(table_name, source_stage):
+        # each table is uploaded as soon as its files are staged
+        def upload(results, stage):
+            upload_stats = {}
+            if copy_slices:
+                # even, slice-aligned parts loaded through COPY manifests
+                table_split_path = os.path.join(split_path, table_name)
+                split_staged_output(source_path, table_split_path,
+                                    capstone_bucket, key_prefix,
+                                    copy_slices * copy_parts_per_slice,
+                                    output_format, compress, (table_name,),
+                                    staged[source_stage])
+                copy_to_s3(table_split_path, capstone_bucket, key_prefix,
+                           f'.{output_format}', compress, upload_workers,
+                           multipart_threshold_mb, multipart_chunksize_mb,
+                           max_concurrency, s3_client=s3_client,
+                           upload_stats=upload_stats)
+                copy_to_s3(os.path.join(table_split_path, 'manifests'),
+                           capstone_bucket, key_prefix + 'manifests/',
+                           '.manifest', False, upload_workers,
+                           s3_client=s3_client, upload_stats=upload_stats)
+            else:
+                copy_to_s3(source_path, capstone_bucket, key_prefix,
+                           file_extension, compress, upload_workers,
+                           multipart_threshold_mb, multipart_chunksize_mb,
+                           max_concurrency, s3_client=s3_client,
+                           upload_stats=upload_stats, table_name=table_name)
+            stage['files'] = [dict(key=key, **stats) for key, stats
+                              in upload_stats.items()]
+            stage['rows'] = manifest_control_totals(staged[source_stage],
+                                                    file_extension)\
+                .get(table_name, 0)
+            stage['bytes_in'] = sum(stats['bytes_in'] for stats
+                                    in upload_stats.values())
+            stage['bytes_out'] = sum(stats['bytes_out'] for stats
+                                     in upload_stats.values())
+        return upload
     
-    if all([uniqueness_check, null_fact_check]):
-        logging.info("Additional data integrity checks passed!")
+    def create_stage(results, stage):
+        # S3 to Redshift
+        con = psycopg2.connect("host={} dbname={} user={} password={} port={}"\
+            .format(*config['CLUSTER'].values()))
+        warehouse['con'] = con
+        warehouse['cur'] = con.cursor()
+        if load_mode == 'merge':
+            # live tables stay queryable, only missing ones are created
+            query_list = create_if_not_exists_queries
+        elif incremental:
+            query_list = incremental_create_table_queries
+            if not ingest['manifest']:
+                # nothing says which files bicycle_fact already holds, so
+                # it's rebuilt instead of every file being appended again
+                query_list = [bicycle_fact_create] + query_list
+            if not loaded_date_range:
+                # nothing says what's already in date_d, rebuild it
+                query_list = query_list + [date_dimension_create]
+        else:
+            query_list = create_table_queries
+        if enriched_tables:
+            query_list = query_list + ([create_if_not_exists(query) for query
+                                        in enriched_create_table_queries]
+                                       if load_mode == 'merge'
+                                       else enriched_create_table_queries)
+        # distribution and sort keys are Redshift's, the direct backend
+        # loads PostgreSQL
+        if table_layout and not direct:
+            query_list = apply_table_layouts(query_list)
+        # kept tables only ever receive this run's rows, one with an older
+        # layout has to be rebuilt from everything by a full load first
+        outdated = outdated_tables(warehouse['cur'], query_list)
+        if outdated:
+            raise ValueError(f"{', '.join(outdated)} still have an older \
+column layout, run once with LOAD_MODE=replace and INCREMENTAL=False to \
+recreate them")
+        # PostgreSQL's DDL is transactional, so the direct backend leaves
+        # the drops and creates uncommitted. The live tables are only
+        # swapped for the new ones when the load stage commits, and a
+        # failed build leaves them as they were
+        create_tables(warehouse['cur'], con, query_list, commit=not direct)
+        if direct:
+            warehouse['lock'] = threading.Lock()
+            warehouse['buffer_rows'] = direct_buffer_rows
+            if load_mode == 'merge':
+                # rows are streamed into temp staging tables and upserted
+                # by the load
+                create_tables(warehouse['cur'], con,
+                              merge_stage_queries()[0], commit=False)
+                warehouse['target_suffix'] = '_stage'
+    
+    def load_stage(results, stage):
+        # tables without a staged row have nothing in S3 to COPY
+        load_columns = {table_name: columns for table_name, columns
+                        in table_columns.items()
+                        if results['output_manifest'].get(table_name)}
+        if direct:
+            # the streamed rows all land when this transaction commits
+            if load_mode == 'merge':
+                creates, upserts, drops = merge_stage_queries()
+                merge_redshift_tables(warehouse['cur'], warehouse['con'],
+                                      upserts + drops)
+            else:
+                warehouse['con'].commit()
+                logging.info("Committed the streamed tables")
+        elif load_mode == 'merge':
+            # the new rows land in one transaction
+            merge_redshift_tables(warehouse['cur'], warehouse['con'],
+                                  merge_load_queries(
+                                      key_prefix, output_format, compress,
+                                      bool(copy_slices),
+                                      table_columns=load_columns))
+        else:
+            load_redshift_tables(warehouse['cur'], warehouse['con'],
+                                 staged_copy_queries(
+                                     key_prefix, output_format, compress,
+                                     bool(copy_slices),
+                                     table_columns=load_columns))
+        stage['rows'] = sum(results['output_manifest'].values())
+        ingest['manifest'] = update_ingest_manifest(
+            ingest['manifest'], ingest['fingerprints'],
+            results['fact_build'], results['metadata'])
+        save_ingest_manifest(ingest['manifest'])
+        if results['dimensions']:
+            save_dimension_state({'date_d': results['dimensions']})
+    
+    def maintenance_stage(results, stage):
+        # freshly created tables are sorted by their COPY, only the ones
+        # rows were added to need a VACUUM
+        if load_mode == 'merge':
+            vacuum_tables = list(table_columns)
+        elif incremental:
+            vacuum_tables = ['bicycle_fact', 'date_d']
+        else:
+            vacuum_tables = []
+        # VACUUM ... TO 100 PERCENT is Redshift's syntax
+        maintain_redshift_tables(
+            warehouse['cur'], warehouse['con'],
+            list(table_columns) if analyze_after_load else [],
+            vacuum_tables if vacuum_after_load and not direct else [])
+    
+    def validation_stage(results, stage):
+        # Control totals
+        source_counts = dict(results['output_manifest'])
+        if incremental:
+            # the fact table accumulates deltas, compare it to everything
+            # the manifest says has been ingested
+            source_counts['bicycle_fact'] = sum(
+                entry['rows'] for entry in ingest['manifest'].values())
+        if extend_date_d and results['dimensions']:
+            # only the new days were staged, date_d holds the whole range
+            source_counts['date_d'] = (
+                pd.Timestamp(results['dimensions']['last_date'])
+                - pd.Timestamp(results['dimensions']['first_date'])).days + 1
+        logging.info(f"Source control totals: {source_counts}")
+        
+        # Control totals, dim uniqueness, and fact null checks in one pass
+        # per table
+        checks = validation_suite + enriched_validation_suite\
+            if enriched_tables else validation_suite
+        validation_report = run_validation_suite(warehouse['cur'], checks,
+                                                 source_counts)
+        stage['rows'] = sum(metrics['row_count'] for metrics
+                            in validation_report['tables'].values())
+        with open(VALIDATION_REPORT_PATH, 'w') as f:
+            json.dump(validation_report, f, indent=2)
+        return validation_report
+    
+    table_sources = {'bicycle_fact': 'fact_build',
+                     'weather_d': 'weather_transform',
+                     'date_d': 'dimensions',
+                     'time_d': 'dimensions',
+                     'counter_d': 'counter_dimension'}
+    if enriched_tables:
+        table_sources.update({table_name: 'enriched' for table_name
+                              in enriched_columns})
+    if direct:
+        # the tables are created first so the rows can be streamed into
+        # them as they're built
+        upload_stages = []
+        create_depends_on = ['metadata']
+        staging_depends_on = ['metadata', 'create']
     else:
-        logging.info("One or more data integrity checks failed, see the logs for details")
+        upload_stages = [{'name': f'upload_{table_name}',
+                          'func': upload_stage(table_name, source_stage),
+                          'depends_on': [source_stage],
+                          'pool': 'io'}
+                         for table_name, source_stage
+                         in table_sources.items()]
+        # tables are only dropped once everything is staged in S3
+        create_depends_on = [stage['name'] for stage in upload_stages]\
+            + ['output_manifest']
+        staging_depends_on = ['metadata']
+    stages = [{'name': 'metadata', 'func': metadata_stage, 'pool': 'io'},
+              {'name': 'download', 'func': download_stage,
+               'depends_on': ['metadata'], 'pool': 'io'},
+              {'name': 'counter_dimension', 'func': counter_dimension_stage,
+               'depends_on': staging_depends_on, 'pool': 'cpu'},
+              {'name': 'fact_build', 'func': fact_build_stage,
+               'depends_on': staging_depends_on, 'pool': 'cpu'},
+              {'name': 'weather_transform', 'func': weather_transform_stage,
+               'depends_on': ['fact_build', 'download'], 'pool': 'cpu'},
+              {'name': 'dimensions', 'func': dimensions_stage,
+               'depends_on': ['fact_build', 'weather_transform'],
+               'pool': 'cpu'},
+              *([{'name': 'enriched', 'func': enriched_stage,
+                  'depends_on': ['fact_build', 'weather_transform'],
+                  'pool': 'cpu'}] if enriched_tables else []),
+              *upload_stages,
+              {'name': 'output_manifest', 'func': output_manifest_stage,
+               'depends_on': list(table_sources.values()), 'pool': 'io'},
+              {'name': 'create', 'func': create_stage,
+               'depends_on': create_depends_on, 'pool': 'io'},
+              {'name': 'load', 'func': load_stage,
+               'depends_on': ['create', 'output_manifest'], 'pool': 'io'},
+              {'name': 'maintenance', 'func': maintenance_stage,
+               'depends_on': ['load'], 'pool': 'io'},
+              {'name': 'validation', 'func': validation_stage,
+               'depends_on': ['maintenance'], 'pool': 'io'}]
+    
+    try:
+        results = run_stages(stages, run_report, stage_io_workers,
+                             stage_cpu_workers, overlap_stages)
+        if results['validation']['passed']:
+            logging.info("Control totals and data integrity checks passed!")
+        else:
+            logging.info("One or more data integrity checks failed, see the logs for details")
+        run_report['status'] = 'succeeded' if results['validation']['passed']\
+            else 'validation_failed'
+    except Exception:
+        run_report['status'] = 'failed'
+        raise
+    finally:
+        if 'con' in warehouse:
+            warehouse['con'].close()
+        save_run_report(run_report, RUN_REPORT_PATH, prometheus_textfile)
+        if quality_gate:
+            with open(QUALITY_REPORT_PATH, 'w') as f:
+                json.dump(quality_report, f, indent=2)
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import json
+import numpy as np
+import pandas as pd
+
+# Checks run on every dataframe before it's staged, so the problems the
+# warehouse validation would only find after a full upload and COPY are
+# caught locally. Each one names a table, a kind, and the columns it looks at
+#   not_null: none of the columns are blank
+#   non_negative: none of the columns are below zero
+#   unique: no two rows share the columns, compared by hashing them. Only
+#       rows that passed the checks listed before it are compared, so list
+#       the unique checks last
+quality_suite = [
+    {'table': 'bicycle_fact', 'kind': 'not_null',
+     'columns': ['counter_id', 'date_id', 'time_id', 'utc_date_id',
+                 'utc_time_id', 'weather_id', 'bicycle_count']},
+    {'table': 'bicycle_fact', 'kind': 'non_negative',
+     'columns': ['bicycle_count']},
+    # a skipped spring-forward hour lands on the same UTC hour as the one
+    # after it, see process_data.build_utc_hour_lookup
+    {'table': 'bicycle_fact', 'kind': 'unique',
+     'columns': ['counter_id', 'utc_date_id', 'utc_time_id']},
+    {'table': 'weather_d', 'kind': 'not_null',
+     'columns': ['weather_id', 'utc_date', 'utc_hour',
+                 'weather_station_code']},
+    {'table': 'weather_d', 'kind': 'unique',
+     'columns': ['weather_station_code', 'utc_date', 'utc_hour']}
+]
+
+def run_quality_checks(dataframe, table_name, checks=quality_suite,
+                       seen_hashes=None, sample_size=5):
+    '''
+    Runs a table's quality checks on a dataframe. Every check works on whole
+        columns at once, duplicates are found by hashing each row's key
+        columns to a single integer
+    Parameters:
+        dataframe (Pandas dataframe)
+        table_name (str): picks the checks to run
+        checks (list): see quality_suite
+        seen_hashes (dict): when given, the key hashes of the earlier chunks
+            of the same file, so duplicates across chunks are caught too.
+            Updated with this chunk's
+        sample_size (int): offending rows kept per check
+    Returns:
+        results (list): per check, its 'kind', 'columns', 'failed' row
+            count, and a 'sample' of the offending rows as records
+        failed (numpy array): True for every row that failed a check
+    '''
+    failed = np.zeros(len(dataframe), dtype=bool)
+    results = []
+    for check in checks:
+        if check['table'] != table_name:
+            continue
+        columns = check['columns']
+        if check['kind'] == 'not_null':
+            offending = dataframe[columns].isna().any(axis=1).to_numpy()
+        elif check['kind'] == 'non_negative':
+            # blank nullable counts compare as <NA>, they're not_null's
+            offending = (dataframe[columns] < 0).fillna(False).any(axis=1)\
+                .to_numpy(dtype=bool)
+        elif check['kind'] == 'unique':
+            hashes = pd.util.hash_pandas_object(dataframe[columns],
+                                                index=False).to_numpy()
+            # the first occurrence is kept, later ones are offending
+            offending = np.zeros(len(dataframe), dtype=bool)
+            offending[~failed] = pd.Series(hashes[~failed])\
+                .duplicated().to_numpy()
+            if seen_hashes is not None:
+                seen = seen_hashes.get(tuple(columns),
+                                       np.array([], dtype='uint64'))
+                offending |= ~failed & np.isin(hashes, seen)
+                seen_hashes[tuple(columns)] = np.concatenate(
+                    [seen, hashes[~failed & ~offending]])
+        else:
+            raise ValueError(f"Unknown quality check '{check['kind']}'")
+        failed |= offending
+        sample = dataframe[offending].head(sample_size)
+        results.append({'kind': check['kind'],
+                        'columns': columns,
+                        'failed': int(offending.sum()),
+                        'sample': json.loads(sample.to_json(
+                            orient='records', date_format='iso'))})
+    return results, failed
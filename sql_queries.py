@@ -1,7 +1,10 @@
 import configparser
+import os
+import re
+from config.definitions import ROOT_DIR
 
 config = configparser.ConfigParser()
-config.read('config\config.cfg')
+config.read(os.path.join(ROOT_DIR, 'config', 'config.cfg'))
 
 s3_bucket = config['S3']['CAPSTONE_BUCKET']
 credentials = config['ARN']['ARN_ROLE']
@@ -12,7 +15,7 @@ date_dimension_create = (
 '''
 DROP TABLE IF EXISTS date_d;
 CREATE TABLE date_d (
-date_id          BIGINT GENERATED ALWAYS AS IDENTITY,
+date_id          INT NOT NULL,
 date             DATE NOT NULL,
 year             INT,
 month            CHAR(10),
@@ -36,7 +39,7 @@ time_dimension_create = (
 '''
 DROP TABLE IF EXISTS time_d;
 CREATE TABLE time_d  (
-    time_id     INT GENERATED ALWAYS AS IDENTITY,
+    time_id     INT NOT NULL,
     fulltime    TIME,
     hour        INT,
     ampm        VARCHAR(2)
@@ -49,15 +52,28 @@ bicycle_fact_create = (
 DROP TABLE IF EXISTS bicycle_fact;
 CREATE TABLE bicycle_fact (
     id                      INT GENERATED ALWAYS AS IDENTITY,
-    local_date              DATE NOT NULL,
-    local_time              VARCHAR(9) NOT NULL,
-    utc_date                DATE NOT NULL,
-    utc_time                VARCHAR(9) NOT NULL,
+    counter_id              INT NOT NULL,
+    date_id                 INT NOT NULL,
+    time_id                 INT NOT NULL,
+    utc_date_id             INT NOT NULL,
+    utc_time_id             INT NOT NULL,
+    weather_id              BIGINT NOT NULL,
+    bicycle_count           NUMERIC
+);
+'''
+)
+
+counter_dimension_create = (
+'''
+DROP TABLE IF EXISTS counter_d;
+CREATE TABLE counter_d (
+    counter_id              INT NOT NULL,
+    counter_location        VARCHAR NOT NULL,
     city                    VARCHAR NOT NULL,
     state                   VARCHAR NOT NULL,
-    counter_location        VARCHAR,
+    country                 VARCHAR NOT NULL,
     weather_station_code    VARCHAR,
-    bicycle_count           NUMERIC
+    time_zone               VARCHAR
 );
 '''
 )
@@ -66,7 +82,7 @@ weather_dimension_create = (
 '''
 DROP TABLE IF EXISTS weather_d;
 CREATE TABLE weather_d (
-    weather_id              INT GENERATED ALWAYS AS IDENTITY,
+    weather_id              BIGINT NOT NULL,
     utc_date                DATE NOT NULL,
     utc_hour                VARCHAR(9) NOT NULL,
     temperature_c           NUMERIC,
@@ -85,117 +101,573 @@ CREATE TABLE weather_d (
 '''
 )
 
-bicycle_fact_copy = (
-f'''
-COPY bicycle_fact FROM 's3://{s3_bucket}/bicycle_fact'
-CREDENTIALS 'aws_iam_role={credentials}'
-CSV
-IGNOREHEADER 1;
+# Optional tables (ENRICHED_TABLES) built locally from the staged facts and
+# weather: every fact with its nearest weather observation, and daily and
+# weekly rollups per counter. Their names can't start with another table's,
+# since COPY loads every object whose key starts with the table name
+bicycle_weather_fact_create = (
+'''
+DROP TABLE IF EXISTS bicycle_weather_fact;
+CREATE TABLE bicycle_weather_fact (
+    counter_id              INT NOT NULL,
+    date_id                 INT NOT NULL,
+    time_id                 INT NOT NULL,
+    utc_date_id             INT NOT NULL,
+    utc_time_id             INT NOT NULL,
+    bicycle_count           NUMERIC,
+    weather_id              BIGINT,
+    weather_offset_hours    INT,
+    temperature_c           NUMERIC,
+    dew_point_c             NUMERIC,
+    relative_humidity_pct   NUMERIC,
+    hourly_precipitation_mm NUMERIC,
+    snow_mm                 NUMERIC,
+    wind_direction_deg      NUMERIC,
+    avg_wind_spd_kmh        NUMERIC,
+    peak_wind_gust_kmh      NUMERIC,
+    air_pressure_hpa        NUMERIC,
+    hourly_sunshine_min     NUMERIC,
+    weather_condition_code  VARCHAR
+);
 '''
 )
 
-weather_d_copy = (
-f'''
-COPY weather_d FROM 's3://{s3_bucket}/weather_d'
-CREDENTIALS 'aws_iam_role={credentials}'
-CSV
-IGNOREHEADER 1;
+bicycle_daily_agg_create = (
+'''
+DROP TABLE IF EXISTS bicycle_daily_agg;
+CREATE TABLE bicycle_daily_agg (
+    counter_id              INT NOT NULL,
+    date_id                 INT NOT NULL,
+    bicycle_count           NUMERIC,
+    counted_hours           INT,
+    weather_hours           INT,
+    min_temperature_c       NUMERIC,
+    avg_temperature_c       NUMERIC,
+    max_temperature_c       NUMERIC,
+    precipitation_mm        NUMERIC,
+    snow_mm                 NUMERIC,
+    rainy_hours             INT
+);
 '''
 )
 
-date_d_copy = (
-f'''
-COPY date_d FROM 's3://{s3_bucket}/date_d'
+bicycle_weekly_agg_create = (
+'''
+DROP TABLE IF EXISTS bicycle_weekly_agg;
+CREATE TABLE bicycle_weekly_agg (
+    counter_id              INT NOT NULL,
+    week_start_id           INT NOT NULL,
+    bicycle_count           NUMERIC,
+    counted_hours           INT,
+    weather_hours           INT,
+    min_temperature_c       NUMERIC,
+    avg_temperature_c       NUMERIC,
+    max_temperature_c       NUMERIC,
+    precipitation_mm        NUMERIC,
+    snow_mm                 NUMERIC,
+    rainy_hours             INT
+);
+'''
+)
+
+# Filled in per run with the S3 key prefix the run's files were staged under
+prefixed_copy = (
+'''
+COPY {target_table} FROM 's3://{s3_bucket}/{key_prefix}{source}'
 CREDENTIALS 'aws_iam_role={credentials}'
-CSV
+CSV{options}
 IGNOREHEADER 1;
 '''
 )
 
-time_d_copy = (
-f'''
-COPY time_d FROM 's3://{s3_bucket}/time_d'
+# Parquet columns are matched by position, so the identity column is left
+# out of the column list
+parquet_copy = (
+'''
+COPY {target_table} ({column_list})
+FROM 's3://{s3_bucket}/{key_prefix}{source}'
 CREDENTIALS 'aws_iam_role={credentials}'
-CSV
-IGNOREHEADER 1;
+FORMAT AS PARQUET{options};
 '''
 )
 
-bicycle_fact_count = (
+# Rows streamed from the client by the direct backend. PostgreSQL only,
+# Redshift doesn't accept COPY FROM STDIN
+stdin_copy = (
 '''
-SELECT COUNT(*) FROM bicycle_fact
+COPY {target_table} ({column_list})
+FROM STDIN
+WITH (FORMAT csv);
 '''
 )
 
-weather_d_count = (
+# weather_d's observations, also carried by bicycle_weather_fact
+weather_measures = ['temperature_c', 'dew_point_c', 'relative_humidity_pct',
+                    'hourly_precipitation_mm', 'snow_mm',
+                    'wind_direction_deg', 'avg_wind_spd_kmh',
+                    'peak_wind_gust_kmh', 'air_pressure_hpa',
+                    'hourly_sunshine_min', 'weather_condition_code']
+
+# Staged columns per table, in file order
+staged_columns = {
+    'bicycle_fact': ['counter_id', 'date_id', 'time_id', 'utc_date_id',
+                     'utc_time_id', 'weather_id', 'bicycle_count'],
+    'weather_d': ['weather_id', 'utc_date', 'utc_hour', *weather_measures,
+                  'weather_station_code'],
+    'date_d': ['date_id', 'date', 'year', 'month', 'month_of_year', 'day_of_month',
+               'day', 'day_of_week', 'weekend', 'day_of_year',
+               'week_of_year', 'quarter', 'previous_day', 'next_day'],
+    'time_d': ['time_id', 'fulltime', 'hour', 'ampm'],
+    'counter_d': ['counter_id', 'counter_location', 'city', 'state',
+                  'country', 'weather_station_code', 'time_zone']
+}
+
+# Staged columns of the optional enriched tables, in file order
+rollup_columns = ['bicycle_count', 'counted_hours', 'weather_hours',
+                  'min_temperature_c', 'avg_temperature_c',
+                  'max_temperature_c', 'precipitation_mm', 'snow_mm',
+                  'rainy_hours']
+enriched_columns = {
+    'bicycle_weather_fact': ['counter_id', 'date_id', 'time_id',
+                             'utc_date_id', 'utc_time_id', 'bicycle_count',
+                             'weather_id', 'weather_offset_hours',
+                             *weather_measures],
+    'bicycle_daily_agg': ['counter_id', 'date_id', *rollup_columns],
+    'bicycle_weekly_agg': ['counter_id', 'week_start_id', *rollup_columns]
+}
+
+# Integer columns the tables declare BIGINT, every other one is an INT.
+# Parquet integers have to be the same width as the column they're COPYed to
+bigint_columns = {'weather_id'}
+
+# Columns that identify a row, used to upsert staged rows into live tables
+natural_keys = {
+    'bicycle_fact': ['counter_id', 'utc_date_id', 'utc_time_id'],
+    'weather_d': ['weather_id'],
+    'date_d': ['date_id'],
+    'time_d': ['time_id'],
+    'counter_d': ['counter_id'],
+    'bicycle_weather_fact': ['counter_id', 'utc_date_id', 'utc_time_id'],
+    'bicycle_daily_agg': ['counter_id', 'date_id'],
+    'bicycle_weekly_agg': ['counter_id', 'week_start_id']
+}
+
+# Empty copy of a live table's staged columns, without the identity column
+stage_table_create = (
 '''
-SELECT COUNT(*) FROM weather_d
+CREATE TEMP TABLE {stage_table} AS
+SELECT {column_list} FROM {table_name} WHERE 1 = 0;
 '''
 )
 
-date_d_count = (
+stage_table_upsert = (
 '''
-SELECT COUNT(*) FROM date_d
+DELETE FROM {table_name}
+USING {stage_table}
+WHERE {key_match};
+INSERT INTO {table_name} ({column_list})
+SELECT {column_list} FROM {stage_table};
 '''
 )
 
-time_d_count = (
+stage_table_drop = (
 '''
-SELECT COUNT(*) FROM time_d
+DROP TABLE IF EXISTS {stage_table};
 '''
 )
 
-bicycle_no_blanks = (
+# Columns of live tables, to tell whether a kept table has an older layout.
+# PostgreSQL flags identity columns in is_identity, Redshift only in their
+# default
+live_table_columns = (
 '''
-SELECT COUNT(*)
-FROM bicycle_fact
-WHERE
-    local_time IS NULL
-OR  local_date IS NULL
-OR  weather_station_code IS NULL
+SELECT table_name, column_name, data_type,
+       is_identity = 'YES' OR COALESCE(column_default, '') LIKE '%%identity%%'
+FROM information_schema.columns
+WHERE table_schema = current_schema()
+AND table_name IN %s;
 '''
 )
 
-weather_uniqueness = (
+# Physical layout of each table. Facts and weather are both distributed on
+# weather_id, the key they're joined on, so the join never moves rows between
+# nodes. The small dimensions are copied to every node. Sort keys lead with
+# the dates queries filter on
+table_layouts = {
+    'bicycle_fact': {'diststyle': 'KEY', 'distkey': 'weather_id',
+                     'sortkey': ['date_id', 'time_id']},
+    'weather_d': {'diststyle': 'KEY', 'distkey': 'weather_id',
+                  'sortkey': ['utc_date', 'utc_hour']},
+    'date_d': {'diststyle': 'ALL', 'sortkey': ['date_id']},
+    'time_d': {'diststyle': 'ALL', 'sortkey': ['time_id']},
+    'counter_d': {'diststyle': 'ALL', 'sortkey': ['counter_id']},
+    'bicycle_weather_fact': {'diststyle': 'EVEN',
+                             'sortkey': ['date_id', 'time_id']},
+    'bicycle_daily_agg': {'diststyle': 'EVEN', 'sortkey': ['date_id']},
+    'bicycle_weekly_agg': {'diststyle': 'EVEN', 'sortkey': ['week_start_id']}
+}
+
+# Post-load maintenance. VACUUM re-sorts rows appended out of sort key order
+# and reclaims the space of deleted ones, ANALYZE refreshes the planner's
+# statistics. Redshift won't run VACUUM inside a transaction
+vacuum_table = (
+'''
+VACUUM FULL {table_name} TO 100 PERCENT;
 '''
-SELECT COUNT(*)
-FROM
-	(SELECT DISTINCT
-        utc_date,
-        utc_hour,
-        weather_station_code
-	FROM weather_d)'''
 )
 
-date_uniqueness = (
+analyze_table = (
 '''
-SELECT COUNT(DISTINCT(date))
-FROM date_d
+ANALYZE {table_name};
 '''
 )
-time_uniqueness = (
+
+# Copy of a live table with a given layout, used to compare layouts
+layout_copy_create = (
+'''
+CREATE TABLE {schema}.{table_name}
+{layout}
+AS SELECT * FROM public.{table_name};
+'''
+)
+
+# Dashboard queries from the README, used to benchmark the table layouts
+rainy_madison_riders = (
+'''
+SELECT d.date, t.hour, SUM(f.bicycle_count) AS riders
+FROM bicycle_fact f
+JOIN weather_d w ON f.weather_id = w.weather_id
+JOIN date_d d ON f.date_id = d.date_id
+JOIN time_d t ON f.time_id = t.time_id
+JOIN counter_d c ON f.counter_id = c.counter_id
+WHERE w.hourly_precipitation_mm > 0.1
+AND d.month_of_year = '09'
+AND d.weekend = 'Weekend'
+AND d.year = 2020
+AND t.ampm = 'AM'
+AND c.state = 'wisconsin'
+AND c.city = 'madison'
+GROUP BY d.date, t.hour
+ORDER BY d.date, t.hour;
+'''
+)
+
+hot_seattle_night_riders = (
 '''
-SELECT COUNT(DISTINCT(fulltime))
-FROM time_d
+SELECT d.month_of_year, t.hour, SUM(f.bicycle_count) AS riders
+FROM bicycle_fact f
+JOIN weather_d w ON f.weather_id = w.weather_id
+JOIN date_d d ON f.date_id = d.date_id
+JOIN time_d t ON f.time_id = t.time_id
+JOIN counter_d c ON f.counter_id = c.counter_id
+WHERE w.temperature_c > 26
+AND d.month_of_year IN ('06', '07', '08')
+AND d.year = 2020
+AND t.hour > 16
+AND c.state = 'washington'
+AND c.city = 'seattle'
+GROUP BY d.month_of_year, t.hour
+ORDER BY d.month_of_year, t.hour;
 '''
 )
 
+dashboard_queries = {'rainy_madison_riders': rainy_madison_riders,
+                     'hot_seattle_night_riders': hot_seattle_night_riders}
+
 # Query Lists
 create_table_queries = [bicycle_fact_create,
                         time_dimension_create,
                         date_dimension_create,
-                        weather_dimension_create]
+                        weather_dimension_create,
+                        counter_dimension_create]
+
+def create_if_not_exists(create_query):
+    '''
+    Turns one of the drop/create statements above into one that leaves an
+        existing table (and its data) alone
+    Parameters:
+        create_query (str)
+    Returns:
+        create_query (str)
+    '''
+    create_query = re.sub(r'DROP TABLE IF EXISTS \w+;\n', '', create_query)
+    return create_query.replace('CREATE TABLE ', 'CREATE TABLE IF NOT EXISTS ')
+
+# information_schema's data_type for each column type the DDL above uses
+information_schema_types = {'INT': 'integer',
+                            'BIGINT': 'bigint',
+                            'NUMERIC': 'numeric',
+                            'VARCHAR': 'character varying',
+                            'CHAR': 'character',
+                            'DATE': 'date',
+                            'TIME': 'time without time zone'}
+
+def kept_tables(query_list):
+    '''
+    Lists the tables a set of DDL creates only if they're missing, leaving
+        existing ones (and their data) in place
+    Parameters:
+        query_list (list)
+    Returns:
+        table_names (set)
+    '''
+    ddl = ''.join(query_list)
+    return set(re.findall(r'CREATE TABLE IF NOT EXISTS (\w+)', ddl))\
+        - set(re.findall(r'DROP TABLE IF EXISTS (\w+)', ddl))
+
+def ddl_columns(query_list):
+    '''
+    Reads the columns each CREATE TABLE in a set of DDL declares
+    Parameters:
+        query_list (list)
+    Returns:
+        table_columns (dict): {'table_name':{'column':(data_type,
+            is_identity),...},...}, data_type as information_schema names it
+    '''
+    table_columns = {}
+    for table_name, body in re.findall(
+            r'CREATE TABLE (?:IF NOT EXISTS )?(\w+)\s*\((.*?)\n\)',
+            ''.join(query_list), flags=re.S):
+        columns = {}
+        for line in body.strip().split('\n'):
+            column_name, column_type = line.split()[:2]
+            columns[column_name] = (
+                information_schema_types[column_type.split('(')[0].rstrip(',')],
+                'GENERATED' in line)
+        table_columns[table_name] = columns
+    return table_columns
+
+def outdated_live_tables(live_columns, query_list):
+    '''
+    Finds the tables a set of DDL keeps in place whose live columns, their
+        types, or their identity differ from what the DDL declares, like a
+        weather_d from before the surrogate keys with an identity INT
+        weather_id
+    Parameters:
+        live_columns (list): rows of live_table_columns
+        query_list (list): the DDL a run is about to execute
+    Returns:
+        outdated (list): the table names
+    '''
+    kept = kept_tables(query_list)
+    declared = ddl_columns(query_list)
+    live = {}
+    for table_name, column_name, data_type, is_identity in live_columns:
+        live.setdefault(table_name, {})[column_name] = (data_type,
+                                                        bool(is_identity))
+    return sorted(table_name for table_name, columns in live.items()
+                  if table_name in kept and columns != declared[table_name])
+
+# Incremental runs keep the fact table and date_d and append deltas to them
+incremental_create_table_queries = [create_if_not_exists(bicycle_fact_create),
+                                    time_dimension_create,
+                                    create_if_not_exists(date_dimension_create),
+                                    weather_dimension_create,
+                                    counter_dimension_create]
+
+create_if_not_exists_queries = [create_if_not_exists(query)
+                                for query in create_table_queries]
+
+enriched_create_table_queries = [bicycle_weather_fact_create,
+                                 bicycle_daily_agg_create,
+                                 bicycle_weekly_agg_create]
 
-copy_table_queries = [bicycle_fact_copy,
-                      weather_d_copy,
-                      date_d_copy,
-                      time_d_copy]
+def table_layout_clause(layout):
+    '''
+    Writes a table layout as the DISTSTYLE/DISTKEY/SORTKEY clause of a
+        CREATE TABLE
+    Parameters:
+        layout (dict): e.g. table_layouts['bicycle_fact']
+    Returns:
+        layout_clause (str)
+    '''
+    clauses = [f"DISTSTYLE {layout['diststyle']}"]
+    if layout.get('distkey'):
+        clauses.append(f"DISTKEY ({layout['distkey']})")
+    if layout.get('sortkey'):
+        clauses.append(f"SORTKEY ({', '.join(layout['sortkey'])})")
+    return '\n'.join(clauses)
 
-target_control_queries = [bicycle_fact_count,
-                          weather_d_count,
-                          date_d_count,
-                          time_d_count]
+def apply_table_layouts(query_list, layouts=table_layouts):
+    '''
+    Adds each table's layout to the CREATE TABLE statements in a query list.
+        Tables without a layout are left to Redshift
+    Parameters:
+        query_list (list): e.g. create_table_queries
+        layouts (dict): {'table_name':layout_dict,...}
+    Returns:
+        query_list (list)
+    '''
+    def add_layout(match):
+        layout = layouts.get(match.group(1))
+        if layout is None:
+            return match.group(0)
+        return f'{match.group(0)[:-1]}\n{table_layout_clause(layout)};'
+    return [re.sub(r'CREATE TABLE (?:IF NOT EXISTS )?(\w+).*?\n\);',
+                   add_layout, query, flags=re.S)
+            for query in query_list]
 
-dim_uniqueness_queries = [weather_uniqueness,
-                          date_uniqueness,
-                          time_uniqueness]
\ No newline at end of file
+def staged_copy_queries(key_prefix='', output_format='csv', gzip=False,
+                        manifest=False, target_suffix='',
+                        table_columns=staged_columns):
+    '''
+    Builds the COPY statements for files staged under an S3 key prefix
+    Parameters:
+        key_prefix (str): e.g. 'incremental/20221016T070000/'
+        output_format (str): 'csv' or 'parquet'
+        gzip (bool): the staged .csv's were gzipped before upload
+        manifest (bool): load exactly the objects listed in
+            {key_prefix}manifests/{table_name}.manifest instead of every
+            object whose key starts with the table name
+        target_suffix (str): COPY into {table_name}{target_suffix}, e.g.
+            a staging table, instead of the table itself
+        table_columns (dict): the tables to load and their staged columns
+    Returns:
+        copy_queries (list)
+    '''
+    template = parquet_copy if output_format == 'parquet' else prefixed_copy
+    options = ('\nGZIP' if gzip else '') + ('\nMANIFEST' if manifest else '')
+    return [template.format(target_table=table_name + target_suffix,
+                            column_list=', '.join(columns),
+                            source=(f'manifests/{table_name}.manifest'
+                                    if manifest else table_name),
+                            options=options,
+                            s3_bucket=s3_bucket,
+                            key_prefix=key_prefix,
+                            credentials=credentials)
+            for table_name, columns in table_columns.items()]
+
+def merge_stage_queries(stage_suffix='_stage', table_columns=staged_columns):
+    '''
+    Builds the statements that create a temp staging table per table and
+        then upsert the staged rows into the live table on its natural key
+    Parameters:
+        stage_suffix (str): staging tables are named {table_name}{suffix}
+        table_columns (dict): the tables to merge and their staged columns
+    Returns:
+        (creates, upserts, drops) (tuple): lists of statements, the
+            staging tables are loaded between the creates and the upserts
+    '''
+    creates, upserts, drops = [], [], []
+    for table_name, columns in table_columns.items():
+        stage_table = table_name + stage_suffix
+        column_list = ', '.join(columns)
+        key_match = ' AND '.join(f'{table_name}.{key} = {stage_table}.{key}'
+                                 for key in natural_keys[table_name])
+        creates.append(stage_table_create.format(stage_table=stage_table,
+                                                 column_list=column_list,
+                                                 table_name=table_name))
+        upserts.append(stage_table_upsert.format(stage_table=stage_table,
+                                                 column_list=column_list,
+                                                 table_name=table_name,
+                                                 key_match=key_match))
+        drops.append(stage_table_drop.format(stage_table=stage_table))
+    return creates, upserts, drops
+
+def merge_load_queries(key_prefix='', output_format='csv', gzip=False,
+                       manifest=False, table_columns=staged_columns):
+    '''
+    Builds the statements that COPY each table's staged files into a temp
+        staging table and then upsert them into the live table on its
+        natural key. Meant to run in order inside a single transaction
+    Parameters:
+        key_prefix (str): e.g. 'incremental/20221016T070000/'
+        output_format (str): 'csv' or 'parquet'
+        gzip (bool): the staged .csv's were gzipped before upload
+        manifest (bool): load through COPY manifests
+        table_columns (dict): the tables to merge and their staged columns
+    Returns:
+        merge_queries (list)
+    '''
+    stage_suffix = '_stage'
+    creates, upserts, drops = merge_stage_queries(stage_suffix, table_columns)
+    copies = staged_copy_queries(key_prefix, output_format, gzip, manifest,
+                                 stage_suffix, table_columns)
+    return creates + copies + upserts + drops
+
+# Checks run against the warehouse after a load. Each one names a table, a
+# kind ('row_count', 'unique', or 'not_null') and, where needed, columns
+validation_suite = [
+    {'table': 'bicycle_fact', 'kind': 'row_count'},
+    {'table': 'bicycle_fact', 'kind': 'not_null',
+     'columns': ['counter_id', 'date_id', 'time_id', 'weather_id']},
+    {'table': 'weather_d', 'kind': 'row_count'},
+    {'table': 'weather_d', 'kind': 'unique',
+     'columns': ['utc_date', 'utc_hour', 'weather_station_code']},
+    {'table': 'weather_d', 'kind': 'unique', 'columns': ['weather_id']},
+    {'table': 'date_d', 'kind': 'row_count'},
+    {'table': 'date_d', 'kind': 'unique', 'columns': ['date']},
+    {'table': 'date_d', 'kind': 'unique', 'columns': ['date_id']},
+    {'table': 'time_d', 'kind': 'row_count'},
+    {'table': 'time_d', 'kind': 'unique', 'columns': ['fulltime']},
+    {'table': 'time_d', 'kind': 'unique', 'columns': ['time_id']},
+    {'table': 'counter_d', 'kind': 'row_count'},
+    {'table': 'counter_d', 'kind': 'unique', 'columns': ['counter_id']}
+]
+
+# Checks on the optional enriched tables
+enriched_validation_suite = [
+    {'table': 'bicycle_weather_fact', 'kind': 'row_count'},
+    {'table': 'bicycle_weather_fact', 'kind': 'not_null',
+     'columns': ['counter_id', 'date_id', 'time_id']},
+    {'table': 'bicycle_daily_agg', 'kind': 'row_count'},
+    {'table': 'bicycle_daily_agg', 'kind': 'unique',
+     'columns': ['counter_id', 'date_id']},
+    {'table': 'bicycle_weekly_agg', 'kind': 'row_count'},
+    {'table': 'bicycle_weekly_agg', 'kind': 'unique',
+     'columns': ['counter_id', 'week_start_id']}
+]
+
+def distinct_key_alias(columns):
+    '''
+    Names the distinct key count for a set of columns in a validation query
+    Parameters:
+        columns (list)
+    Returns:
+        alias (str)
+    '''
+    return 'distinct_' + '_'.join(columns)
+
+def compile_validation_suite(checks):
+    '''
+    Compiles a list of validation checks into one query per table that
+        returns the row count, every distinct key count, and every null
+        count in a single scan. Multi-column keys are counted as one
+        delimited string, with NULLs kept distinct from empty strings, so
+        they match a SELECT DISTINCT over the same columns
+    Parameters:
+        checks (list): e.g. validation_suite
+    Returns:
+        validation_queries (dict): {'table_name':(query, [alias,...]),...}
+            with the aliases in the same order as the selected values
+    '''
+    table_checks = {}
+    for check in checks:
+        table_checks.setdefault(check['table'], []).append(check)
+
+    validation_queries = {}
+    for table_name, checks_on_table in table_checks.items():
+        expressions = {'row_count': 'COUNT(*)'}
+        for check in checks_on_table:
+            if check['kind'] == 'not_null':
+                for column in check['columns']:
+                    expressions[f'null_{column}'] =\
+                        f'COUNT(*) - COUNT({column})'
+            elif check['kind'] == 'unique':
+                key = " || '|' || ".join(
+                    f"COALESCE(CAST({column} AS VARCHAR), '<null>')"
+                    for column in check['columns'])
+                expressions[distinct_key_alias(check['columns'])] =\
+                    f'COUNT(DISTINCT {key})'
+            elif check['kind'] != 'row_count':
+                raise ValueError(f"Unknown validation kind '{check['kind']}'")
+        select_list = ',\n    '.join(f'{expression} AS {alias}'
+                                      for alias, expression
+                                      in expressions.items())
+        query = f'''
+SELECT
+    {select_list}
+FROM {table_name};
+'''
+        validation_queries[table_name] = (query, list(expressions))
+    return validation_queries
\ No newline at end of file
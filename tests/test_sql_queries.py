@@ -0,0 +1,41 @@
+from sql_queries import incremental_create_table_queries, create_if_not_exists_queries, weather_dimension_create, ddl_columns, outdated_live_tables
+
+def live_rows(table_name, columns):
+    '''
+    Builds live_table_columns rows for a table
+    Parameters:
+        table_name (str)
+        columns (dict): {'column':(data_type, is_identity),...}
+    Returns:
+        rows (list)
+    '''
+    return [(table_name, column_name, data_type, is_identity)
+            for column_name, (data_type, is_identity) in columns.items()]
+
+def test_current_layout_is_kept():
+    declared = ddl_columns(create_if_not_exists_queries)
+    rows = live_rows('weather_d', declared['weather_d'])\
+        + live_rows('bicycle_fact', declared['bicycle_fact'])
+    assert outdated_live_tables(rows, create_if_not_exists_queries) == []
+
+def test_identity_keyed_weather_d_is_outdated():
+    # weather_d before the surrogate keys, same column names
+    columns = dict(ddl_columns([weather_dimension_create])['weather_d'])
+    columns['weather_id'] = ('integer', True)
+    rows = live_rows('weather_d', columns)
+    assert outdated_live_tables(rows, create_if_not_exists_queries)\
+        == ['weather_d']
+
+def test_identity_keyed_date_d_is_outdated():
+    columns = dict(ddl_columns(incremental_create_table_queries)['date_d'])
+    columns['date_id'] = ('bigint', True)
+    rows = live_rows('date_d', columns)
+    assert outdated_live_tables(rows, incremental_create_table_queries)\
+        == ['date_d']
+
+def test_recreated_tables_are_not_checked():
+    # incremental runs drop and recreate weather_d
+    columns = dict(ddl_columns([weather_dimension_create])['weather_d'])
+    columns['weather_id'] = ('integer', True)
+    rows = live_rows('weather_d', columns)
+    assert outdated_live_tables(rows, incremental_create_table_queries) == []